@@ -1,6 +1,7 @@
 import base64
 import configparser
 import logging
+import sys
 from logging.handlers import RotatingFileHandler
 from typing import List, TypedDict
 
@@ -9,6 +10,8 @@ class SOARCustomerDetails(TypedDict):
     soar_api_key_auth: str
     soar_org_id: str
     siem_org_id:str
+    scheduling_weight: int
+    max_concurrent_posts: int
     
 class ServerConfig:
     '''Class for app configuration. Contains main configuration variables that are used for the app.'''
@@ -18,12 +21,45 @@ class ServerConfig:
         self.qradar_api_key:str = None
         self.failed_escalations_offenses_file:str = None
         self.last_escalated_offense_file:str = None
+        self.dead_letter_offenses_file:str = None
+        self.escalation_outbox_file:str = None
         self.logging_level:str = None
         self.cli_logging_enabled:bool = None
         self.polling_rate_new_offenses_checking:int = None
         self.polling_rate_offenses_failure_reuploading:int = None
+        self.qradar_gzip_responses:bool = None
+        self.soar_gzip_requests:bool = None
+        self.profiling_signals_enabled:bool = None
+        self.profiling_admin_port:int = None
+        self.profiling_mode:str = None
+        self.profiling_sample_interval:float = None
+        self.profiling_top_allocations:int = None
+        self.profiling_output_dir:str = None
         self.customer_configurations: dict[str,SOARCustomerDetails] = {}
+        self.customer_configurations_by_domain: dict[str,SOARCustomerDetails] = {}
+        self.soar_org_weights: dict[str,int] = {}
+        self.soar_org_concurrency_limits: dict[str,int] = {}
+        self.soar_post_workers:int = None
+        self.per_org_concurrency:int = None
+        self.offenses_fetch_batch_size:int = None
+        self.max_queued_offenses_per_org:int = None
+        self.qradar_domain_filter_chunk_size:int = None
+        self.qradar_filter_max_length:int = None
+        self.qradar_domain_filter_max_workers:int = None
         self.customer_orgs: list[str] = []
+        self.siem_domains: list[str] = []
+        self.notifications_enabled:bool = None
+        self.notifications_bind_address:str = None
+        self.notifications_http_port:int = None
+        self.notifications_udp_port:int = None
+        self.notifications_token:str = None
+        self.notifications_coalesce_window:float = None
+        self.notifications_safety_polling_rate:int = None
+        self.coordination_enabled:bool = None
+        self.coordination_lease_store_file:str = None
+        self.coordination_instance_id:str = None
+        self.coordination_lease_ttl:int = None
+        self.coordination_heartbeat_interval:int = None
 
 def is_valid_section(section_data):
     """Check if the section has valid values for soar_api_id, soar_api_key, soar_org_id and siem_org_id."""
@@ -55,6 +91,20 @@ def is_valid_section(section_data):
     
     return False
 
+def get_optional_positive_int(section_data, option:str, section:str):
+    '''Returns an optional positive integer option of a customer section, or None if it is missing or invalid.'''
+    value = section_data.get(option)
+    if value is None or value.strip() == "":
+        return None
+    try:
+        value = int(value)
+        if value < 1:
+            raise ValueError()
+        return value
+    except ValueError:
+        print(f"Option {option} of section {section} should be an integer value bigger or equal than 1. Using the default value.")
+        return None
+
 def generate_basic_auth(api_id, api_key):
     # Combine the API ID and API key with a colon
     credentials = f"{api_id}:{api_key}"
@@ -66,22 +116,29 @@ def generate_basic_auth(api_id, api_key):
 def filter_valid_sections(config):
 
     valid_sections = {}
+    #Many customers share the same SOAR API credentials. Encode each pair only once.
+    basic_auth_cache: dict[tuple[str,str],str] = {}
 
     sections: List[str] = config.sections()
     # Iterate over all sections
     for section in sections:
-        customer_name = section.replace("Customer_", "", 1)
         # Filter sections that start with 'Customer_'
         if section.startswith('Customer_'):
+            customer_name = section[len("Customer_"):]
             if bool(customer_name.strip()):
-                customer_name = section.replace("Customer_", "", 1)
                 section_data = dict(config.items(section))           
                 # Check if the section is valid
                 if is_valid_section(section_data):
+                    credentials = (section_data.get("soar_api_id"), section_data.get("soar_api_key"))
+                    soar_api_key_auth = basic_auth_cache.get(credentials)
+                    if soar_api_key_auth is None:
+                        soar_api_key_auth = basic_auth_cache[credentials] = generate_basic_auth(*credentials)
                     valid_sections[section] = {
                         "soar_org_id": section_data.get("soar_org_id"),
                         "siem_org_id": section_data.get("siem_org_id"),
-                        "soar_api_key_auth": generate_basic_auth(section_data.get("soar_api_id"), section_data.get("soar_api_key"))
+                        "soar_api_key_auth": soar_api_key_auth,
+                        "scheduling_weight": get_optional_positive_int(section_data, "scheduling_weight", section) or 1,
+                        "max_concurrent_posts": get_optional_positive_int(section_data, "max_concurrent_posts", section)
                     }
                 else:
                     print(f"Section {section} had invalid data. Customer section will be ommited and offenses might not be escalated for such customer.")
@@ -91,21 +148,32 @@ def filter_valid_sections(config):
     return valid_sections
 
 def get_customer_domains(customer_configs:dict[str,dict[any]]):
-    customer_names = []
+    '''Returns the customer names (section names without the Customer_ prefix) without duplicates, keeping the order of the config.ini file.'''
     if customer_configs:
-        pass
-        for key in customer_configs.keys():
-            print(key)
-            customer_name = key.split("Customer_",1)[1].strip()
-            print(customer_name)
-            try:
-                found = customer_names.index(customer_name,0)
-            except ValueError:
-                customer_names.append(customer_name)
-        return customer_names
+        #dict.fromkeys de-duplicates in linear time and keeps the insertion order
+        return list(dict.fromkeys(key.split("Customer_",1)[1].strip() for key in customer_configs.keys()))
     else:
         return []
 
+def index_customers_by_domain(customer_configs:dict[str,SOARCustomerDetails]) -> dict[str,SOARCustomerDetails]:
+    '''Indexes the customer configurations by their QRADAR domain ID, so the SOAR organization of an offense is found in constant time.
+    If several sections use the same domain, the first one wins.'''
+    customers_by_domain = {}
+    for customer in customer_configs.values():
+        customers_by_domain.setdefault(str(int(customer.get("siem_org_id"))), customer)
+    return customers_by_domain
+
+def get_soar_org_scheduling(customer_configs:dict[str,SOARCustomerDetails]) -> tuple[dict[str,int],dict[str,int]]:
+    '''Returns the scheduling weights and concurrent posts limits of every SOAR organization. If several customers share a SOAR organization, the highest values are used.'''
+    weights = {}
+    concurrency_limits = {}
+    for customer in customer_configs.values():
+        org = str(int(customer.get("soar_org_id")))
+        weights[org] = max(weights.get(org, 0), customer.get("scheduling_weight") or 1)
+        if customer.get("max_concurrent_posts"):
+            concurrency_limits[org] = max(concurrency_limits.get(org, 0), customer.get("max_concurrent_posts"))
+    return weights, concurrency_limits
+
 def get_logging_level(level:str):
     '''Maps the logging level string to a corresponding logging level integer valule. If an invalid one is passed, will default to INFO.
 
@@ -163,6 +231,11 @@ def init_server_config():
     server_config.qradar_api_key = config.get('MainConfig', 'qradar_api_key')
     server_config.failed_escalations_offenses_file = config.get('MainConfig', 'failed_escalations_offenses_file')
     server_config.last_escalated_offense_file = config.get('MainConfig', 'last_escalated_offense_file')
+    server_config.dead_letter_offenses_file = config.get('MainConfig', 'dead_letter_offenses_file', fallback='dead_letter_offenses.jsonl')
+    server_config.escalation_outbox_file = config.get('MainConfig', 'escalation_outbox_file', fallback='escalation_outbox.jsonl')
+
+    server_config.qradar_gzip_responses = config.getboolean('MainConfig', 'qradar_gzip_responses', fallback=True)
+    server_config.soar_gzip_requests = config.getboolean('MainConfig', 'soar_gzip_requests', fallback=False)
 
     config_level = config.get('Logging','logging_level')
     server_config.logging_level = get_logging_level(config_level)
@@ -198,9 +271,125 @@ def init_server_config():
         print(f"[QRadar2IBM_SOAR_automated_escalation]  WARNING Reuploading failed offenses to IBM SOAR polling time in seconds is misconfigured. Should be an integer value from 5 to 3600. Defaulting to 15 (seconds)")
         server_config.polling_rate_offenses_failure_reuploading = 1800
 
+    server_config.profiling_signals_enabled = config.getboolean('Profiling', 'profiling_signals_enabled', fallback=True)
+    server_config.profiling_output_dir = config.get('Profiling', 'profiling_output_dir', fallback='logs').strip() or 'logs'
+    server_config.profiling_mode = config.get('Profiling', 'profiling_mode', fallback='sampling').strip().lower()
+    if server_config.profiling_mode not in ('sampling', 'cprofile'):
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Profiling mode is misconfigured. Should be sampling or cprofile. Defaulting to sampling")
+        server_config.profiling_mode = 'sampling'
+    elif server_config.profiling_mode == 'cprofile' and sys.version_info >= (3, 12):
+        #cProfile is built on the process wide sys.monitoring since Python 3.12: the profiler of one worker records every thread and the others can not be enabled
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Profiling mode cprofile is not supported on Python 3.12 or later (cProfile can not profile every thread on its own). Defaulting to sampling")
+        server_config.profiling_mode = 'sampling'
+    try:
+        server_config.profiling_admin_port = config.getint('Profiling', 'profiling_admin_port', fallback=0)
+        if server_config.profiling_admin_port < 0 or server_config.profiling_admin_port > 65535:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Profiling admin port is misconfigured. Should be an integer value from 1 to 65535 (or 0 to disable it). Disabling the admin socket")
+        server_config.profiling_admin_port = 0
+    try:
+        server_config.profiling_sample_interval = config.getint('Profiling', 'profiling_sample_interval_ms', fallback=10) / 1000
+        if server_config.profiling_sample_interval <= 0:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Profiling sample interval is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to 10 (milliseconds)")
+        server_config.profiling_sample_interval = 0.01
+    try:
+        server_config.profiling_top_allocations = config.getint('Profiling', 'profiling_top_allocations', fallback=25)
+        if server_config.profiling_top_allocations < 1:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Profiling top allocations is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to 25")
+        server_config.profiling_top_allocations = 25
+
+    try:
+        server_config.qradar_domain_filter_chunk_size = config.getint('MainConfig', 'qradar_domain_filter_chunk_size', fallback=200)
+        if server_config.qradar_domain_filter_chunk_size < 1:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING QRADAR domain filter chunk size is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to 200 (domains)")
+        server_config.qradar_domain_filter_chunk_size = 200
+    try:
+        server_config.qradar_filter_max_length = config.getint('MainConfig', 'qradar_filter_max_length', fallback=4000)
+        if server_config.qradar_filter_max_length < 100:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING QRADAR filter max length is misconfigured. Should be an integer value bigger or equal than 100. Defaulting to 4000 (characters)")
+        server_config.qradar_filter_max_length = 4000
+    try:
+        server_config.qradar_domain_filter_max_workers = config.getint('MainConfig', 'qradar_domain_filter_max_workers', fallback=4)
+        if server_config.qradar_domain_filter_max_workers < 1:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING QRADAR domain filter max workers is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to 4")
+        server_config.qradar_domain_filter_max_workers = 4
+
+    for option, attribute, default in (('soar_post_workers', 'soar_post_workers', 4), ('per_org_concurrency', 'per_org_concurrency', 1),
+                                       ('fetch_batch_size', 'offenses_fetch_batch_size', 50), ('max_queued_offenses_per_org', 'max_queued_offenses_per_org', 200)):
+        try:
+            value = config.getint('Scheduling', option, fallback=default)
+            if value < 1:
+                raise ValueError()
+        except:
+            print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Scheduling {option} is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to {default}")
+            value = default
+        setattr(server_config, attribute, value)
+
+    server_config.notifications_enabled = config.getboolean('Notifications', 'notifications_enabled', fallback=False)
+    server_config.notifications_bind_address = config.get('Notifications', 'bind_address', fallback='127.0.0.1').strip() or '127.0.0.1'
+    server_config.notifications_token = config.get('Notifications', 'notification_token', fallback='').strip()
+    for option, attribute in (('http_port', 'notifications_http_port'), ('udp_port', 'notifications_udp_port')):
+        try:
+            port = config.getint('Notifications', option, fallback=0)
+            if port < 0 or port > 65535:
+                raise ValueError()
+        except:
+            print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Notifications {option} is misconfigured. Should be an integer value from 1 to 65535 (or 0 to disable it). Disabling it")
+            port = 0
+        setattr(server_config, attribute, port)
+    if server_config.notifications_enabled and not (server_config.notifications_http_port or server_config.notifications_udp_port):
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Notifications are enabled but neither http_port nor udp_port are configured. Disabling notifications")
+        server_config.notifications_enabled = False
+    try:
+        server_config.notifications_coalesce_window = config.getint('Notifications', 'coalesce_window_ms', fallback=500) / 1000
+        if server_config.notifications_coalesce_window < 0:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Notifications coalesce window is misconfigured. Should be an integer value bigger or equal than 0. Defaulting to 500 (milliseconds)")
+        server_config.notifications_coalesce_window = 0.5
+    try:
+        server_config.notifications_safety_polling_rate = config.getint('Notifications', 'safety_net_polling_rate', fallback=60)
+        if server_config.notifications_safety_polling_rate < 1:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Notifications safety net polling rate is misconfigured. Should be an integer value bigger or equal than 1. Defaulting to 60 (seconds)")
+        server_config.notifications_safety_polling_rate = 60
+
+    server_config.coordination_enabled = config.getboolean('Coordination', 'coordination_enabled', fallback=False)
+    server_config.coordination_lease_store_file = config.get('Coordination', 'lease_store_file', fallback='coordination_leases.sqlite')
+    server_config.coordination_instance_id = config.get('Coordination', 'instance_id', fallback='').strip()
+    try:
+        server_config.coordination_lease_ttl = config.getint('Coordination', 'lease_ttl_seconds', fallback=30)
+        if server_config.coordination_lease_ttl < 3:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Lease TTL is misconfigured. Should be an integer value bigger or equal than 3. Defaulting to 30 (seconds)")
+        server_config.coordination_lease_ttl = 30
+    try:
+        server_config.coordination_heartbeat_interval = config.getint('Coordination', 'heartbeat_interval_seconds', fallback=10)
+        if server_config.coordination_heartbeat_interval < 1 or server_config.coordination_heartbeat_interval * 2 >= server_config.coordination_lease_ttl:
+            raise ValueError()
+    except:
+        print(f"[QRadar2IBM_SOAR_automated_escalation] WARNING Lease heartbeat interval is misconfigured. Should be an integer value bigger or equal than 1 and less than half of the lease TTL. Defaulting to a third of the lease TTL")
+        server_config.coordination_heartbeat_interval = max(1, server_config.coordination_lease_ttl // 3)
+
     #Get customer config and customer domains
     server_config.customer_configurations = filter_valid_sections(config)
     server_config.customer_orgs = get_customer_domains(server_config.customer_configurations)
+    server_config.customer_configurations_by_domain = index_customers_by_domain(server_config.customer_configurations)
+    server_config.siem_domains = list(server_config.customer_configurations_by_domain.keys())
+    server_config.soar_org_weights, server_config.soar_org_concurrency_limits = get_soar_org_scheduling(server_config.customer_configurations)
 
 
     return server_config
@@ -273,10 +462,29 @@ app_bootstrap_logger.critical(f"    Current LOG LEVEL: {server_config.logging_le
 app_bootstrap_logger.critical(f"    CLI Logging enabled?: {server_config.cli_logging_enabled}")
 app_bootstrap_logger.critical(f"    QRADAR URL: {server_config.qradar_url}")
 app_bootstrap_logger.critical(f"    SOAR URL: {server_config.soar_url}")
+app_bootstrap_logger.critical(f"    Request gzip compressed responses from QRADAR?: {server_config.qradar_gzip_responses}")
+app_bootstrap_logger.critical(f"    Send gzip compressed bodies to SOAR?: {server_config.soar_gzip_requests}")
+app_bootstrap_logger.critical(f"    QRADAR domains per offense query / max filter length / concurrent queries: {server_config.qradar_domain_filter_chunk_size} / {server_config.qradar_filter_max_length} / {server_config.qradar_domain_filter_max_workers}")
 app_bootstrap_logger.critical(f"    Last Escalated Offense ID file location: {server_config.last_escalated_offense_file}")
 app_bootstrap_logger.critical(f"    Failed Escalated Offense IDs file location: {server_config.failed_escalations_offenses_file}")
+app_bootstrap_logger.critical(f"    Dead-letter Offenses file location: {server_config.dead_letter_offenses_file}")
+app_bootstrap_logger.critical(f"    Escalation outbox file location: {server_config.escalation_outbox_file}")
 app_bootstrap_logger.critical(f"    Time to wait for polling new offenses from QRADAR and sending them to IBM SOAR: {server_config.polling_rate_new_offenses_checking}")
 app_bootstrap_logger.critical(f"    Time to wait for sending new failed offenses from QRADAR to IBM SOAR: {server_config.polling_rate_offenses_failure_reuploading}")
+app_bootstrap_logger.critical(f"    Profiling signals (SIGUSR1/SIGUSR2) enabled?: {server_config.profiling_signals_enabled}")
+app_bootstrap_logger.critical(f"    Profiling admin socket port (0 is disabled): {server_config.profiling_admin_port}")
+app_bootstrap_logger.critical(f"    Profiling mode: {server_config.profiling_mode}")
+app_bootstrap_logger.critical(f"    SOAR post workers / concurrent posts per SOAR organization: {server_config.soar_post_workers} / {server_config.per_org_concurrency}")
+app_bootstrap_logger.critical(f"    Offenses fetched per QRADAR query / max queued offenses per SOAR organization: {server_config.offenses_fetch_batch_size} / {server_config.max_queued_offenses_per_org}")
+app_bootstrap_logger.critical(f"    SOAR organization scheduling weights: {server_config.soar_org_weights}")
+app_bootstrap_logger.critical(f"    Offense notification listener enabled?: {server_config.notifications_enabled}")
+if server_config.notifications_enabled:
+    app_bootstrap_logger.critical(f"    Offense notification listener HTTP/UDP ports (0 is disabled): {server_config.notifications_http_port} / {server_config.notifications_udp_port} on {server_config.notifications_bind_address}")
+    app_bootstrap_logger.critical(f"    Safety net polling rate with notifications enabled: {server_config.notifications_safety_polling_rate}")
+app_bootstrap_logger.critical(f"    Multi-instance lease coordination enabled?: {server_config.coordination_enabled}")
+if server_config.coordination_enabled:
+    app_bootstrap_logger.critical(f"    Lease store file location: {server_config.coordination_lease_store_file}")
+    app_bootstrap_logger.critical(f"    Lease TTL / heartbeat interval: {server_config.coordination_lease_ttl} / {server_config.coordination_heartbeat_interval} seconds")
 app_bootstrap_logger.critical(f"    SIEM/SOAR Organization configurations: {server_config.customer_configurations}")
 app_bootstrap_logger.critical(f"    SIEM Organization Names properly parsed: {server_config.customer_orgs}")
 app_bootstrap_logger.critical(f"Integrating QRADAR Offenses with IBM SOAR Now!...")
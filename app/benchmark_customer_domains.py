@@ -0,0 +1,94 @@
+'''Benchmark for MSSP-sized tenant lists. Loads a config with 5,000 Customer_ sections (previous quadratic loading vs current linear loading)
+and polls all of their domains (one single filter vs size-bounded filter chunks queried concurrently).
+
+QRADAR is simulated: every query takes a fixed latency plus a cost per character of its filter. Both costs are synthetic constants (not measured on
+a real QRADAR), so the timings only compare the strategies under that model. Replace them with the latencies observed on your QRADAR before drawing
+conclusions. The poll is measured with every domain sharing a checkpoint (single instance) and with a checkpoint per domain (coordination enabled).
+Run it from the folder with the config.ini file: python app/benchmark_customer_domains.py'''
+import base64
+import configparser
+import time
+from concurrent.futures import ThreadPoolExecutor
+import app_config
+import qradar_siem_offenses_to_soar
+
+CUSTOMERS = 5000
+SHARED_CREDENTIALS = 50 #Number of different SOAR API credentials shared by the customers
+QRADAR_LATENCY = 0.05 #Seconds per query (synthetic)
+QRADAR_COST_PER_CHARACTER = 0.00002 #Seconds per character of the filter (synthetic)
+
+def build_config(customers:int) -> configparser.ConfigParser:
+    '''Returns a config with a Customer_ section per customer.'''
+    config = configparser.ConfigParser()
+    config.read_dict({
+        f"Customer_{i}": {"soar_api_id": f"api-id-{i % SHARED_CREDENTIALS}", "soar_api_key": f"api-key-{i % SHARED_CREDENTIALS}", "soar_org_id": str(200 + i), "siem_org_id": str(i + 1)}
+        for i in range(customers)
+    })
+    return config
+
+def previous_config_loading(config:configparser.ConfigParser):
+    '''Previous loading: Basic auth encoded on every section and de-duplication of the customer names with list.index.'''
+    valid_sections = {}
+    for section in config.sections():
+        if section.startswith('Customer_'):
+            section_data = dict(config.items(section))
+            if app_config.is_valid_section(section_data):
+                credentials = f"{section_data.get('soar_api_id')}:{section_data.get('soar_api_key')}"
+                valid_sections[section] = {"soar_org_id": section_data.get("soar_org_id"), "siem_org_id": section_data.get("siem_org_id"),
+                                           "soar_api_key_auth": base64.b64encode(credentials.encode("utf-8")).decode("utf-8")}
+    customer_names = []
+    for key in valid_sections.keys():
+        customer_name = key.split("Customer_",1)[1].strip()
+        try:
+            customer_names.index(customer_name,0)
+        except ValueError:
+            customer_names.append(customer_name)
+    return valid_sections, customer_names
+
+def current_config_loading(config:configparser.ConfigParser):
+    '''Current loading, as done by init_server_config.'''
+    valid_sections = app_config.filter_valid_sections(config)
+    return valid_sections, app_config.get_customer_domains(valid_sections), app_config.index_customers_by_domain(valid_sections)
+
+def simulated_qradar_query(offense_filter:str):
+    '''Simulates a QRADAR offenses query. Returns the first offense of the first domain on the filter.'''
+    domains = offense_filter.rsplit("domain_id in (", 1)[1].split(")")[0].split(",")
+    time.sleep(QRADAR_LATENCY + QRADAR_COST_PER_CHARACTER * len(offense_filter))
+    return [{"id": 1000 + int(domains[0]), "domain_id": int(domains[0])}]
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    config = build_config(CUSTOMERS)
+    _, previous_seconds = timed(lambda: previous_config_loading(config))
+    (valid_sections, _, customers_by_domain), current_seconds = timed(lambda: current_config_loading(config))
+    print(f"Config loading of {CUSTOMERS} customer sections: previous {previous_seconds * 1000:.1f} ms, current {current_seconds * 1000:.1f} ms")
+
+    server_config = app_config.server_config
+    server_config.customer_configurations = valid_sections
+    server_config.customer_configurations_by_domain = customers_by_domain
+    server_config.siem_domains = list(customers_by_domain.keys())
+    qradar_siem_offenses_to_soar.init_vars(server_config)
+    qradar_siem_offenses_to_soar.fetch_offenses = simulated_qradar_query
+    print(f"Simulated QRADAR (synthetic model): {QRADAR_LATENCY * 1000:.0f} ms per query + {QRADAR_COST_PER_CHARACTER * 1000000:.0f} us per filter character")
+    scenarios = (("shared checkpoint", {domain: 1 for domain in server_config.siem_domains}),
+                 ("checkpoint per domain", {domain: 1000000 + int(domain) for domain in server_config.siem_domains}))
+    for scenario, domain_checkpoints in scenarios:
+        single_filter = qradar_siem_offenses_to_soar.build_offense_filter(domain_checkpoints)
+        _, single_seconds = timed(lambda: simulated_qradar_query(single_filter))
+        print(f"[{scenario}] Single filter poll: {len(single_filter)} characters, {single_seconds * 1000:.1f} ms (simulated)")
+
+        for chunk_size, max_length, workers in ((200, 4000, 1), (200, 4000, 4), (500, 8000, 4), (200, 4000, 8)):
+            server_config.qradar_domain_filter_chunk_size = chunk_size
+            server_config.qradar_filter_max_length = max_length
+            qradar_siem_offenses_to_soar.qradar_query_executor = ThreadPoolExecutor(max_workers=workers)
+            chunks = qradar_siem_offenses_to_soar.build_offense_filter_chunks(domain_checkpoints, chunk_size, max_length)
+            offenses, chunked_seconds = timed(lambda: qradar_siem_offenses_to_soar.get_latest_offenses(domain_checkpoints))
+            assert [offense["id"] for offense in offenses] == sorted(offense["id"] for offense in offenses)
+            print(f"[{scenario}] Chunked poll ({chunk_size} domains / {max_length} characters per chunk, {workers} workers): {len(chunks)} queries of up to {max(len(chunk) for chunk in chunks)} characters, {chunked_seconds * 1000:.1f} ms (simulated)")
+
+if __name__ == "__main__":
+    main()
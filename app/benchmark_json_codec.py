@@ -0,0 +1,73 @@
+'''Micro-benchmark for the per-offense JSON work. Compares the previous serialization path (stdlib json, body serialized twice
+and QRADAR responses decoded with the stdlib parser) against the json_codec path (single serialization with the fastest backend available).
+
+Run it from the app folder: python benchmark_json_codec.py'''
+import gzip
+import json
+import timeit
+import json_codec
+
+ITERATIONS = 20000
+
+def sample_offense(offense_id:int = 1234):
+    '''Returns an offense similar to the ones returned by the QRADAR offenses endpoint.'''
+    return {
+        "id": offense_id, "description": "Multiple Login Failures for the Same User\n preceded by Excessive Firewall Denies",
+        "offense_source": "10.10.10.10", "offense_type": 0, "domain_id": 3, "severity": 7, "magnitude": 5, "credibility": 3,
+        "relevance": 4, "status": "OPEN", "event_count": 1520, "flow_count": 0, "category_count": 4, "start_time": 1729300000000,
+        "last_updated_time": 1729300500000, "first_persisted_time": 1729300001000, "assigned_to": None, "follow_up": False,
+        "categories": ["User Login Failure", "Firewall Deny", "Access Denied", "Misc Login Failed"],
+        "rules": [{"id": 100000 + i, "type": "CRE_RULE"} for i in range(5)],
+        "log_sources": [{"id": 60 + i, "name": f"FW-{i}", "type_id": 10, "type_name": "Firewall"} for i in range(5)],
+        "source_address_ids": list(range(20)), "local_destination_address_ids": list(range(20)),
+        "destination_networks": ["other"], "source_network": "Net-10-172-192.Net_10_0_0_0", "security_category_count": 4,
+        "close_time": None, "closing_user": None, "closing_reason_id": None, "inactive": False, "protected": False,
+        "device_count": 5, "policy_category_count": 0, "username_count": 1, "remote_destination_count": 0,
+    }
+
+def sample_incident_body(offense):
+    '''Returns a SOAR incident body built the same way as build_soar_incident_body does.'''
+    return {
+        "discovered_date": offense["start_time"],
+        "description": f"{offense['event_count']} events in {offense['category_count']} categories: {offense['description']}",
+        "confirmed": "false",
+        "start_date": offense["start_time"],
+        "incident_type_ids": ["System Intrusion"],
+        "severity_code": "Medium",
+        "name": f"QRADAR ID {offense['id']} , {offense['description']} - {offense['offense_source']}",
+        "artifacts": [{"type": "IP Address", "value": offense["offense_source"], "description": offense["description"], "properties": [{"name": "source", "value": "true"}]}]
+    }
+
+def previous_path(raw_response:bytes):
+    '''Old per-offense path: stdlib decode, debug dump, unused json.dumps and the json= serialization made by requests.'''
+    offenses = json.loads(raw_response)
+    json.dumps(offenses)
+    body = sample_incident_body(offenses[0])
+    json.dumps(body)
+    json.dumps(body, allow_nan=False).encode("utf-8")
+
+def codec_path(raw_response:bytes, use_gzip:bool = False):
+    '''New per-offense path: codec decode and a single serialization of the body (the batch is only dumped for the logs with DEBUG logging).'''
+    offenses = json_codec.loads(raw_response)
+    json_codec.encode_body(sample_incident_body(offenses[0]), use_gzip)
+
+def run_benchmark(name:str, fn) -> float:
+    '''Runs a benchmark function and prints the time per offense in microseconds.'''
+    seconds = min(timeit.repeat(fn, number=ITERATIONS, repeat=3))
+    per_offense = seconds / ITERATIONS * 1_000_000
+    print(f"{name:<45} {per_offense:8.2f} us/offense")
+    return per_offense
+
+def main():
+    raw_response = json.dumps([sample_offense()]).encode("utf-8")
+    body = json_codec.dumps(sample_incident_body(sample_offense()))
+
+    print(f"JSON backend in use: {json_codec.JSON_BACKEND}")
+    print(f"SOAR body size: {len(body)} bytes ({len(gzip.compress(body, compresslevel=5))} bytes gzip compressed)")
+    previous = run_benchmark("stdlib json, body serialized twice", lambda: previous_path(raw_response))
+    current = run_benchmark("json_codec, body serialized once", lambda: codec_path(raw_response))
+    run_benchmark("json_codec, body serialized once + gzip", lambda: codec_path(raw_response, True))
+    print(f"CPU saved per offense (without gzip): {previous - current:.2f} us ({(1 - current / previous) * 100:.1f}%)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+'''Dead-letter store for offenses that failed permanently when escalated to IBM SOAR.
+
+Every entry is a JSON line with the offense ID, the thread that dead-lettered it and the error payload (see escalation_errors.describe_failure).
+Dead-lettered offenses are excluded from the retry sweeps until an operator requeues them (requeue_dead_letter_offenses.py).'''
+import os
+import threading
+from contextlib import contextmanager
+import json_codec
+from durable_files import append_lines, interprocess_file_lock, write_file_atomically
+
+dead_letter_lock = threading.Lock() #Both threads write on the store
+
+@contextmanager
+def dead_letter_file_guard(file_path:str):
+    """Locks the dead-letter file between the threads of this process and between processes (the app and the requeue command)."""
+    with dead_letter_lock, interprocess_file_lock(file_path):
+        yield
+
+def load_dead_letter_offenses(file_path:str) -> dict[int, dict]:
+    """Load the dead-lettered offenses from the dead-letter file.
+
+    :param str file_path: Path of the dead-letter file.
+    :return: Dict with the dead-lettered offense IDs as keys and their entries as values. Last entry wins if an ID is repeated.
+    :rtype: dict[int,dict]
+    :raises OSError: if an error occurs when opening/reading the file
+    """
+    entries = {}
+    if not os.path.exists(file_path):
+        return entries
+    with open(file_path, 'rb') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json_codec.loads(line)
+                entries[int(entry["offense_id"])] = entry
+            except Exception:
+                #A line that was not fully written (crash in the middle of an append) is ignored
+                continue
+    return entries
+
+def get_dead_letter_offense_ids(file_path:str) -> set[int]:
+    """Returns the IDs of the dead-lettered offenses.
+
+    :param str file_path: Path of the dead-letter file.
+    :return: Set of offense IDs.
+    :rtype: set[int]
+    """
+    with dead_letter_file_guard(file_path):
+        return set(load_dead_letter_offenses(file_path).keys())
+
+def add_dead_letter_offense(file_path:str, offense_id:int, failure:dict, source:str) -> None:
+    """Appends an offense to the dead-letter file.
+
+    :param str file_path: Path of the dead-letter file.
+    :param int offense_id: ID of the offense that failed permanently.
+    :param dict failure: Error payload of the failure (escalation_errors.describe_failure).
+    :param str source: Name of the process that dead-lettered the offense.
+    :return: Nothing.
+    :rtype: None
+    :raises OSError: if an error occurs when opening/writing the file
+    """
+    entry = {"offense_id": offense_id, "source": source}
+    entry.update(failure)
+    with dead_letter_file_guard(file_path):
+        append_lines(file_path, [json_codec.dumps(entry)])
+
+def remove_dead_letter_offenses(file_path:str, offense_ids:set[int] = None) -> list[dict]:
+    """Removes offenses from the dead-letter file. The file is rewritten atomically.
+
+    :param str file_path: Path of the dead-letter file.
+    :param set[int] offense_ids: IDs of the offenses to remove. If None, every offense is removed.
+    :return: Entries removed from the file.
+    :rtype: list[dict]
+    :raises OSError: if an error occurs when opening/writing the file
+    """
+    with dead_letter_file_guard(file_path):
+        entries = load_dead_letter_offenses(file_path)
+        removed = [entry for offense_id, entry in entries.items() if offense_ids is None or offense_id in offense_ids]
+        if not removed:
+            return removed
+        write_file_atomically(file_path, b"".join(json_codec.dumps(entry) + b"\n" for offense_id, entry in entries.items() if offense_ids is not None and offense_id not in offense_ids))
+        return removed
@@ -0,0 +1,77 @@
+'''Crash safe file operations shared by the files of the app (checkpoint, failed offenses, dead-letter and escalation outbox files).
+
+Appends are flushed to disk and always start on a new line, rewrites go through a temporary file that replaces the original once flushed,
+and files shared between processes are locked with a .lock file next to them (only on platforms with fcntl).'''
+import os
+from contextlib import contextmanager
+from typing import IO, List, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def append_lines(file_path:str, lines:List[bytes]) -> None:
+    """Appends lines to a file and flushes them to disk.
+
+    :param str file_path: Path of the file.
+    :param List[bytes] lines: Lines to append (without the line break).
+    :return: Nothing.
+    :rtype: None
+    :raises OSError: if an error occurs when opening/writing the file"""
+    with open(file_path, 'a+b') as file:
+        #Start on a new line if a previous append was interrupted in the middle of a line
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                file.write(b"\n")
+        file.write(b"".join(line + b"\n" for line in lines))
+        file.flush()
+        os.fsync(file.fileno())
+
+def write_file_atomically(file_path:str, content:Union[str, bytes]) -> None:
+    """Writes a file through a temporary file that replaces it once flushed to disk, so a crash never leaves it half written.
+
+    :param str file_path: Path of the file to write.
+    :param str|bytes content: Content of the file.
+    :return: Nothing.
+    :rtype: None
+    :raises OSError: if an error occurs when writing/replacing the file"""
+    temp_file_path = file_path + ".tmp"
+    with open(temp_file_path, 'wb' if isinstance(content, bytes) else 'w') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_path, file_path)
+
+@contextmanager
+def interprocess_file_lock(file_path:str):
+    '''Locks a file between processes (using a .lock file next to it). Used to edit files shared by several processes (instances of the app, operator commands).
+    Does nothing on platforms without fcntl.'''
+    if fcntl is None:
+        yield
+        return
+    with open(file_path + ".lock", 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def lock_file_exclusively(file_path:str) -> IO:
+    '''Locks a file for this process without waiting (using a .lock file next to it). The lock is held until the returned file is closed
+    or the process exits.
+
+    :return: The open lock file, or None on platforms without fcntl.
+    :rtype: IO
+    :raises OSError: if another process holds the lock
+    '''
+    if fcntl is None:
+        return None
+    lock_file = open(file_path + ".lock", 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise
+    return lock_file
@@ -0,0 +1,67 @@
+'''Classification of the errors raised while escalating offenses from QRADAR to IBM SOAR.
+
+Permanent failures (configuration errors, rejected payloads, invalid credentials...) will never succeed by retrying them and are sent
+to the dead-letter store. Everything else (timeouts, connection errors, 5xx, 429...) is considered transient and retried.'''
+import time
+import requests
+
+#HTTP status codes that will return the same answer no matter how many times the request is retried.
+PERMANENT_HTTP_STATUS_CODES = {400, 401, 403, 404, 405, 410, 413, 415, 422}
+#Errors raised by requests before sending anything, caused by a malformed configuration (empty or invalid soar_url/qradar_url, API keys with invalid characters...)
+PERMANENT_REQUEST_ERRORS = (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL, requests.exceptions.InvalidHeader)
+#Max length of the response body stored with a failure
+MAX_ERROR_RESPONSE_LENGTH = 2000
+
+class PermanentEscalationError(Exception):
+    '''Raised when an offense can not be escalated to IBM SOAR until the configuration or the offense are fixed.'''
+    pass
+
+class ReconciliationError(Exception):
+    '''Raised when IBM SOAR can not be queried to check whether an offense was already escalated. Always transient: the offense was not posted.'''
+    pass
+
+def get_http_status_code(error: Exception) -> int:
+    '''Returns the HTTP status code of the response attached to a requests exception (if any).
+
+    :param Exception error: Exception to inspect.
+    :return: Status code of the response or None if the exception has no response.
+    :rtype: int
+    '''
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def is_permanent_failure(error: Exception) -> bool:
+    '''Classifies an exception raised while escalating an offense.
+
+    :param Exception error: Exception to classify.
+    :return: True if retrying will not fix the failure. False if it is transient.
+    :rtype: bool
+    '''
+    if isinstance(error, ReconciliationError):
+        return False
+    if isinstance(error, (PermanentEscalationError,) + PERMANENT_REQUEST_ERRORS):
+        return True
+    return get_http_status_code(error) in PERMANENT_HTTP_STATUS_CODES
+
+def describe_failure(error: Exception) -> dict:
+    '''Builds the error payload stored with a failed offense.
+
+    :param Exception error: Exception raised when escalating the offense.
+    :return: Dict with the classification, error type and message, status code and the response body (truncated) if any.
+    :rtype: dict
+    '''
+    response = getattr(error, "response", None)
+    response_body = None
+    if response is not None:
+        try:
+            response_body = response.text[:MAX_ERROR_RESPONSE_LENGTH]
+        except Exception:
+            response_body = None
+    return {
+        "classification": "permanent" if is_permanent_failure(error) else "transient",
+        "error_type": type(error).__name__,
+        "error": str(error),
+        "status_code": get_http_status_code(error),
+        "response": response_body,
+        "failed_at": int(time.time()),
+    }
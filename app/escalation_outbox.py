@@ -0,0 +1,152 @@
+'''Write-ahead outbox of the escalations to IBM SOAR.
+
+Every fetched offense is recorded (with its payload) before it is queued, every post is recorded before it is sent and its outcome after it.
+Records are appended to a JSON lines file and flushed to disk, so after a crash or restart a single pass over the file tells which offenses were
+queued but not sent (they are queued again without fetching them from QRADAR) and which posts were interrupted (their outcome is checked on
+SOAR before posting them again). Entries no longer needed are dropped when the file is compacted.'''
+import os
+import threading
+from typing import Dict, List
+import json_codec
+from durable_files import append_lines, lock_file_exclusively, write_file_atomically
+
+QUEUED = "queued"
+SENDING = "sending"
+DONE = "done"
+#The file is compacted when it has this many records more than open entries
+COMPACTION_THRESHOLD = 10000
+
+class EscalationOutbox:
+    '''Outbox of the offenses escalated to SOAR. Thread safe.
+
+    Entries are kept in memory (offense ID -> state, checkpoint key, domain and offense payload while not done) and appended to the file
+    on every change. Done entries are kept until their checkpoint is saved past them, so they are not escalated twice if they are fetched
+    again after a restart.'''
+    def __init__(self, file_path:str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._entries: Dict[int, dict] = {}
+        self._records = 0
+        self._checkpoints: Dict[str, int] = {}
+        self._lock_file = None
+
+    def lock_exclusively(self) -> None:
+        '''Locks the outbox for this process until it exits (a .lock file next to it), so two processes never resume the same escalations.
+        Does nothing on platforms without fcntl.
+
+        :raises RuntimeError: if another process holds the outbox
+        '''
+        if self._lock_file is not None:
+            return
+        try:
+            self._lock_file = lock_file_exclusively(self.file_path)
+        except OSError:
+            raise RuntimeError(f"The escalation outbox {self.file_path} is in use by another process. Every instance needs its own outbox (a different instance_id with coordination).")
+
+    def load(self) -> Dict[int, dict]:
+        '''Reads the outbox file in a single pass and returns the entries (last record of each offense wins). A record that was
+        not fully written (crash in the middle of an append) is ignored.
+
+        :return: Dict with the offense IDs as keys and the entries as values.
+        :rtype: Dict[int,dict]
+        :raises OSError: if an error occurs when opening/reading the file
+        '''
+        entries = {}
+        records = 0
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json_codec.loads(line)
+                        offense_id = int(record["offense_id"])
+                    except Exception:
+                        continue
+                    records += 1
+                    entry = entries.get(offense_id)
+                    if entry is None or "offense" in record:
+                        entries[offense_id] = record
+                    else:
+                        entry.update(record)
+                    if entries[offense_id].get("state") == DONE:
+                        entries[offense_id].pop("offense", None)
+        with self._lock:
+            self._entries = entries
+            self._records = records
+        return dict(entries)
+
+    def _append(self, records:List[dict]) -> None:
+        '''Appends records to the file and flushes them to disk. Must be called with the lock held.'''
+        append_lines(self.file_path, [json_codec.dumps(record) for record in records])
+        self._records += len(records)
+
+    def get(self, offense_id:int) -> dict:
+        '''Returns the entry of an offense, or None if the offense is not on the outbox.'''
+        with self._lock:
+            entry = self._entries.get(offense_id)
+            return dict(entry) if entry is not None else None
+
+    def record_queued(self, offenses:List[tuple[dict, str]]) -> None:
+        '''Records fetched offenses before queuing them.
+
+        :param List[tuple[dict,str]] offenses: Offenses and their checkpoint keys.
+        '''
+        if not offenses:
+            return
+        records = [{"offense_id": offense.get("id"), "state": QUEUED, "key": key, "domain_id": offense.get("domain_id"), "offense": offense} for offense, key in offenses]
+        with self._lock:
+            self._append(records)
+            for record in records:
+                self._entries[record["offense_id"]] = record
+
+    def record_sending(self, offense:dict, key:str) -> None:
+        '''Records that an offense is about to be posted to SOAR.'''
+        offense_id = offense.get("id")
+        with self._lock:
+            entry = self._entries.get(offense_id)
+            if entry is None:
+                record = {"offense_id": offense_id, "state": SENDING, "key": key, "domain_id": offense.get("domain_id"), "offense": offense}
+                self._entries[offense_id] = record
+            else:
+                record = {"offense_id": offense_id, "state": SENDING}
+                entry.update(record)
+            self._append([record])
+
+    def record_outcome(self, offense_id:int, outcome:str) -> None:
+        '''Records the outcome of an offense (sent, failed...). The entry is done and its payload is not kept anymore.'''
+        record = {"offense_id": offense_id, "state": DONE, "outcome": outcome}
+        with self._lock:
+            self._append([record])
+            entry = self._entries.get(offense_id)
+            if entry is not None:
+                entry.update(record)
+                entry.pop("offense", None)
+            if self._records - len(self._entries) > COMPACTION_THRESHOLD:
+                self._compact()
+
+    def checkpoint_saved(self, key:str, checkpoint:int) -> None:
+        '''Tells the outbox a checkpoint was saved. Done entries up to it are dropped on the next compaction.'''
+        with self._lock:
+            self._checkpoints[key] = max(checkpoint, self._checkpoints.get(key, checkpoint))
+
+    def forget(self, keys:List[str]) -> None:
+        '''Drops every entry of the checkpoint keys (domains released to or taken over by another instance) and rewrites the file if any was dropped.'''
+        keys = set(keys)
+        with self._lock:
+            for key in keys:
+                self._checkpoints.pop(key, None)
+            entries = {offense_id: entry for offense_id, entry in self._entries.items() if entry.get("key") not in keys}
+            if len(entries) != len(self._entries):
+                self._entries = entries
+                self._compact()
+
+    def compact(self) -> None:
+        '''Rewrites the file atomically with only the entries still needed.'''
+        with self._lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        '''Drops the done entries already covered by the saved checkpoint of their key and rewrites the file atomically. Must be called with the lock held.'''
+        self._entries = {offense_id: entry for offense_id, entry in self._entries.items()
+                         if entry.get("state") != DONE or offense_id > self._checkpoints.get(entry.get("key"), -1)}
+        write_file_atomically(self.file_path, b"".join(json_codec.dumps(entry) + b"\n" for entry in self._entries.values()))
+        self._records = len(self._entries)
@@ -0,0 +1,90 @@
+'''Per-tenant fair scheduling of the offenses between their fetch from QRADAR and their post to IBM SOAR.
+
+Every SOAR organization has its own queue. Queues are served with deficit round-robin (every turn an organization can post up to
+its weight in offenses) and each organization has a limit of concurrent posts, so a burst of offenses of one tenant does not delay the others.'''
+import threading
+from collections import deque
+from typing import Any, Dict, Tuple
+
+class FairOffenseScheduler:
+    '''Deficit round-robin scheduler with a queue and a concurrency limit per SOAR organization. Thread safe.'''
+    def __init__(self, weights:Dict[str,int] = None, concurrency_limits:Dict[str,int] = None, default_weight:int = 1, default_concurrency:int = 1):
+        self.weights = weights or {}
+        self.concurrency_limits = concurrency_limits or {}
+        self.default_weight = default_weight
+        self.default_concurrency = default_concurrency
+        self._queues: Dict[str, deque] = {}
+        self._deficits: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._active: deque = deque() #Organizations with queued offenses, in round-robin order
+        self._queued = 0
+        self._condition = threading.Condition()
+
+    def submit(self, org:str, item:Any) -> None:
+        '''Queues an item (offense) for a SOAR organization.'''
+        with self._condition:
+            queue = self._queues.get(org)
+            if queue is None:
+                queue = self._queues[org] = deque()
+            if not queue:
+                self._active.append(org)
+                self._deficits[org] = 0
+            queue.append(item)
+            self._queued += 1
+            self._condition.notify()
+
+    def queued(self) -> int:
+        '''Returns the number of queued items (not counting the ones being posted).'''
+        with self._condition:
+            return self._queued
+
+    def queued_by_org(self) -> Dict[str,int]:
+        '''Returns the number of queued items of every organization with queued items.'''
+        with self._condition:
+            return {org: len(queue) for org, queue in self._queues.items() if queue}
+
+    def _pick(self) -> Tuple[str, Any]:
+        '''Picks the next item following deficit round-robin. Organizations at their concurrency limit are skipped without losing their turn credit.'''
+        for _ in range(len(self._active)):
+            org = self._active[0]
+            if self._in_flight.get(org, 0) >= self.concurrency_limits.get(org, self.default_concurrency):
+                self._active.rotate(-1)
+                continue
+            if self._deficits[org] <= 0:
+                self._deficits[org] += self.weights.get(org, self.default_weight)
+            queue = self._queues[org]
+            item = queue.popleft()
+            self._queued -= 1
+            self._deficits[org] -= 1
+            self._in_flight[org] = self._in_flight.get(org, 0) + 1
+            if not queue:
+                #An idle organization does not keep credit for later
+                self._active.popleft()
+                self._deficits[org] = 0
+            elif self._deficits[org] <= 0:
+                self._active.rotate(-1)
+            return org, item
+        return None
+
+    def next(self, timeout:float = None) -> Tuple[str, Any]:
+        '''Waits for the next item to post.
+
+        :param float timeout: Max time to wait in seconds. None waits forever.
+        :return: Tuple with the organization and the item, or None if the timeout expired. task_done(org) must be called once the item is posted.
+        :rtype: Tuple[str,Any]
+        '''
+        with self._condition:
+            picked = self._pick()
+            if picked is None:
+                self._condition.wait_for(lambda: self._pick_ready(), timeout)
+                picked = self._pick()
+            return picked
+
+    def _pick_ready(self) -> bool:
+        return any(self._in_flight.get(org, 0) < self.concurrency_limits.get(org, self.default_concurrency) for org in self._active)
+
+    def task_done(self, org:str) -> None:
+        '''Marks an item of the organization as posted, freeing one of its concurrent posts.'''
+        with self._condition:
+            self._in_flight[org] -= 1
+            self._condition.notify_all()
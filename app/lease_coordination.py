@@ -0,0 +1,250 @@
+'''Lease based coordination between several instances of the app sharing a volume.
+
+Every QRADAR domain (siem_org_id) is a partition. Each instance claims partitions with time-bounded leases stored on a shared SQLite
+file and renews them with heartbeats. Partitions are balanced between the live instances and, when an instance dies, the surviving ones
+take over its expired leases and continue from the per-partition checkpoints (last escalated offense ID) saved on the same store.'''
+import math
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Set
+from app_config import ServerConfig, app_bootstrap_logger
+
+#Partition leased by the instance in charge of the failed offenses retry sweeps (only one instance retries them at a time).
+FAILED_OFFENSES_SWEEP_PARTITION = "__failed_offenses_sweep__"
+
+class SQLiteLeaseStore:
+    '''Lease, heartbeat and checkpoint store on a SQLite file. Every operation is run on its own short transaction,
+    so the store can be used from several threads and processes (SQLite locks the file between processes).'''
+    def __init__(self, db_file:str, busy_timeout:float = 30):
+        self.db_file = db_file
+        self.busy_timeout = busy_timeout
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS instances (instance_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (partition TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS checkpoints (partition TEXT PRIMARY KEY, last_offense_id INTEGER NOT NULL, updated_by TEXT, updated_at REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS posts (partition TEXT NOT NULL, offense_id INTEGER NOT NULL, owner TEXT NOT NULL, started_at REAL, PRIMARY KEY (partition, offense_id))")
+
+    @contextmanager
+    def _transaction(self):
+        '''Opens a connection and runs a write transaction (BEGIN IMMEDIATE takes the write lock upfront, avoiding deadlocks between readers that upgrade).'''
+        connection = sqlite3.connect(self.db_file, timeout=self.busy_timeout, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.close()
+
+    def heartbeat(self, instance_id:str) -> None:
+        '''Records that the instance is alive.'''
+        with self._transaction() as connection:
+            connection.execute("INSERT INTO instances (instance_id, heartbeat_at) VALUES (?, ?) ON CONFLICT(instance_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                               (instance_id, time.time()))
+
+    def live_instances(self, ttl:float) -> List[str]:
+        '''Returns the instances that sent a heartbeat in the last ttl seconds (and forgets the dead ones).'''
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM instances WHERE heartbeat_at < ?", (time.time() - 3 * ttl,))
+            rows = connection.execute("SELECT instance_id FROM instances WHERE heartbeat_at >= ? ORDER BY instance_id", (time.time() - ttl,)).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire(self, partitions:List[str], owner:str, ttl:float, limit:int) -> Dict[str, float]:
+        '''Acquires up to limit partitions that are free, expired or already owned by the owner (renewing them).
+
+        :param List[str] partitions: Candidate partitions, in order of preference.
+        :param str owner: Instance acquiring the leases.
+        :param float ttl: Duration of the leases in seconds.
+        :param int limit: Max number of partitions to hold after the call.
+        :return: Dict of the partitions held by the owner and the expiration time of their leases.
+        :rtype: Dict[str,float]
+        '''
+        now = time.time()
+        expires_at = now + ttl
+        held = {}
+        with self._transaction() as connection:
+            current = dict(connection.execute("SELECT partition, owner FROM leases WHERE expires_at >= ?", (now,)).fetchall())
+            #Renew the owned partitions first, then claim the free ones
+            for partition in sorted(partitions, key=lambda p: current.get(p) != owner):
+                if len(held) >= limit:
+                    break
+                if current.get(partition) not in (None, owner):
+                    continue
+                connection.execute("INSERT INTO leases (partition, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT(partition) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                                   (partition, owner, expires_at))
+                held[partition] = expires_at
+        return held
+
+    def release(self, partitions:List[str], owner:str) -> None:
+        '''Releases the leases of the owner on the partitions.'''
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM leases WHERE partition = ? AND owner = ?", [(partition, owner) for partition in partitions])
+
+    def get_checkpoints(self, partitions:List[str]) -> Dict[str, int]:
+        '''Returns the last escalated offense ID saved for each partition (partitions without checkpoint are not returned).'''
+        with self._transaction() as connection:
+            rows = connection.execute(f"SELECT partition, last_offense_id FROM checkpoints WHERE partition IN ({','.join('?' * len(partitions))})", partitions).fetchall() if partitions else []
+        return dict(rows)
+
+    def save_checkpoint(self, partition:str, offense_id:int, owner:str) -> bool:
+        '''Saves the checkpoint of a partition only if the owner still holds its lease (fencing).
+
+        :return: True if the checkpoint was saved. False if the lease was lost.
+        :rtype: bool
+        '''
+        now = time.time()
+        with self._transaction() as connection:
+            if connection.execute("SELECT 1 FROM leases WHERE partition = ? AND owner = ? AND expires_at >= ?", (partition, owner, now)).fetchone() is None:
+                return False
+            connection.execute("INSERT INTO checkpoints (partition, last_offense_id, updated_by, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT(partition) DO UPDATE SET last_offense_id = MAX(last_offense_id, excluded.last_offense_id), updated_by = excluded.updated_by, updated_at = excluded.updated_at",
+                               (partition, offense_id, owner, now))
+            #Posts covered by the checkpoint are never escalated again, so they are forgotten
+            connection.execute("DELETE FROM posts WHERE partition = ? AND offense_id <= ?", (partition, offense_id))
+        return True
+
+    def record_post(self, partition:str, offense_id:int, owner:str) -> None:
+        '''Records that the owner is about to post an offense of a partition to SOAR. The record is kept until the checkpoint of the
+        partition moves past the offense, so an instance taking over the partition knows which offenses may already be on SOAR.'''
+        with self._transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO posts (partition, offense_id, owner, started_at) VALUES (?, ?, ?, ?)", (partition, offense_id, owner, time.time()))
+
+    def get_posts(self, partitions:List[str]) -> Set[int]:
+        '''Returns the IDs of the offenses of the partitions whose post was started and not checkpointed yet.'''
+        with self._transaction() as connection:
+            rows = connection.execute(f"SELECT offense_id FROM posts WHERE partition IN ({','.join('?' * len(partitions))})", partitions).fetchall() if partitions else []
+        return {row[0] for row in rows}
+
+class LeaseCoordinator:
+    '''Keeps the leases of an instance. A heartbeat thread renews them, claims its fair share of the partitions
+    (ceil(partitions / live instances)) and releases the extra ones when new instances join.'''
+    def __init__(self, store:SQLiteLeaseStore, instance_id:str, partitions:List[str], lease_ttl:float, heartbeat_interval:float):
+        self.store = store
+        self.instance_id = instance_id
+        self.partitions = list(dict.fromkeys(partitions))
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        #Held while an instance works on its partitions. Leases are only released (rebalancing) between iterations of the work.
+        self.work_lock = threading.RLock()
+        self._leases: Dict[str, float] = {}
+        self._leases_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+        self._release_listeners: List[Callable[[List[str]], None]] = []
+
+    def add_release_listener(self, listener:Callable[[List[str]], None]) -> None:
+        '''Registers a function called with the partitions about to be released to rebalance them (holding the work lock), so the work
+        in progress on them can finish and save its checkpoint while the leases are still held.'''
+        self._release_listeners.append(listener)
+
+    def start(self) -> None:
+        '''Claims the first leases and starts the heartbeat thread.'''
+        self.refresh_leases()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="lease_heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''Stops the heartbeat thread and releases every lease, so other instances take over without waiting for them to expire.'''
+        self._stop.set()
+        with self._leases_lock:
+            partitions = list(self._leases)
+            self._leases = {}
+        self.store.release(partitions, self.instance_id)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.refresh_leases()
+            except Exception as e:
+                app_bootstrap_logger.error(f"Error renewing the leases of instance {self.instance_id}: {str(e)}")
+
+    def refresh_leases(self) -> None:
+        '''Sends a heartbeat, renews the owned leases and claims/releases partitions to keep the fair share.'''
+        self.store.heartbeat(self.instance_id)
+        live_instances = max(1, len(self.store.live_instances(self.lease_ttl)))
+        fair_share = math.ceil(len(self.partitions) / live_instances)
+
+        with self._leases_lock:
+            owned = [partition for partition in self.partitions if partition in self._leases]
+        extra = owned[fair_share:]
+        if extra:
+            with self.work_lock:
+                for listener in self._release_listeners:
+                    try:
+                        listener(extra)
+                    except Exception as e:
+                        app_bootstrap_logger.error(f"Error finishing the work on partitions {extra} before releasing them: {str(e)}")
+                self.store.release(extra, self.instance_id)
+                with self._leases_lock:
+                    for partition in extra:
+                        self._leases.pop(partition, None)
+            app_bootstrap_logger.info(f"Instance {self.instance_id} released partitions {extra} to rebalance them between {live_instances} instances.")
+
+        held = self.store.acquire(self.partitions, self.instance_id, self.lease_ttl, fair_share)
+        held.update(self.store.acquire([FAILED_OFFENSES_SWEEP_PARTITION], self.instance_id, self.lease_ttl, 1))
+        with self._leases_lock:
+            taken_over = set(held) - set(self._leases)
+            lost = set(self._leases) - set(held)
+            self._leases = held
+        if taken_over:
+            app_bootstrap_logger.info(f"Instance {self.instance_id} acquired the leases of partitions {sorted(taken_over)}.")
+        if lost:
+            app_bootstrap_logger.warning(f"Instance {self.instance_id} lost the leases of partitions {sorted(lost)}.")
+
+    def owns(self, partition:str) -> bool:
+        '''True if the instance holds a lease for the partition that will not expire during the next heartbeat interval.'''
+        with self._leases_lock:
+            return self._leases.get(partition, 0) > time.time() + min(self.heartbeat_interval, self.lease_ttl / 2)
+
+    def owned_partitions(self) -> Set[str]:
+        '''Returns the domain partitions currently owned by the instance.'''
+        return {partition for partition in self.partitions if self.owns(partition)}
+
+    def get_checkpoints(self, partitions:List[str], default_offense_id:int) -> Dict[str, int]:
+        '''Returns the checkpoint of each partition. Partitions that were never checkpointed start from default_offense_id.'''
+        checkpoints = self.store.get_checkpoints(list(partitions))
+        return {partition: checkpoints.get(partition, default_offense_id) for partition in partitions}
+
+    def save_checkpoint(self, partition:str, offense_id:int) -> bool:
+        '''Saves the checkpoint of a partition if the lease is still held.'''
+        return self.store.save_checkpoint(partition, offense_id, self.instance_id)
+
+    def record_post(self, partition:str, offense_id:int) -> None:
+        '''Records that an offense of a partition is about to be posted to SOAR (see SQLiteLeaseStore.record_post).'''
+        self.store.record_post(partition, offense_id, self.instance_id)
+
+    def get_started_posts(self, partitions:List[str]) -> Set[int]:
+        '''Returns the offenses of the partitions whose post was started (by any instance) and not checkpointed yet.'''
+        return self.store.get_posts(list(partitions))
+
+coordinator: LeaseCoordinator = None
+
+def partitions_work_lock():
+    '''Returns the lock to hold while working on the leased partitions (no lock without coordination).'''
+    return coordinator.work_lock if coordinator is not None else nullcontext()
+
+def init_coordination(server_config: ServerConfig, partitions:List[str]) -> LeaseCoordinator:
+    '''Creates and starts the lease coordinator if coordination is enabled on the config.ini file.
+
+    :param ServerConfig server_config: Configuration of the app.
+    :param List[str] partitions: Partitions (QRADAR domain IDs) to share between the instances.
+    :return: The lease coordinator or None if coordination is disabled.
+    :rtype: LeaseCoordinator
+    '''
+    global coordinator
+    if not server_config.coordination_enabled:
+        return None
+    #The instance ID must survive restarts: the instance finds its escalation outbox by it
+    instance_id = server_config.coordination_instance_id or socket.gethostname()
+    if not server_config.coordination_instance_id:
+        app_bootstrap_logger.warning(f"No instance_id configured for the coordination. Using the hostname ({instance_id}). Instances running on the same host need a distinct instance_id.")
+    store = SQLiteLeaseStore(server_config.coordination_lease_store_file)
+    coordinator = LeaseCoordinator(store, instance_id, partitions, server_config.coordination_lease_ttl, server_config.coordination_heartbeat_interval)
+    coordinator.start()
+    app_bootstrap_logger.info(f"Lease coordination enabled. Instance {instance_id} sharing partitions {partitions} through {server_config.coordination_lease_store_file}")
+    return coordinator
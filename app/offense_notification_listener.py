@@ -0,0 +1,119 @@
+'''Local listener for offense notifications pushed by QRADAR (rule responses or custom actions) when an offense is created or updated.
+
+Notifications can be sent to an HTTP webhook (POST with a JSON body like {"domain_id": 3, "offense_id": 1234}) or as syslog/UDP messages
+containing domain_id=3. Every notification wakes the offenses thread immediately for the notified domain. Bursts of notifications are
+coalesced in a single wake-up, and the periodic polling keeps running at a slower rate as a safety net.'''
+import hmac
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Set
+from urllib.parse import parse_qs, urlparse
+import json_codec
+from app_config import ServerConfig, offenses_to_ibm_soar_logger
+
+#Notified domain used when a notification does not say which domain was affected. Every domain is queried.
+ALL_DOMAINS = "*"
+DOMAIN_ID_PATTERN = re.compile(r"domain(?:_id)?\s*[=:]\s*\"?(\d+)", re.IGNORECASE)
+MAX_NOTIFICATION_SIZE = 65536
+
+class OffenseNotificationQueue:
+    '''Pending notified domains. Notifications received while the offenses thread is working are kept for its next wake-up.'''
+    def __init__(self, coalesce_window:float):
+        self.coalesce_window = coalesce_window
+        self._pending: Set[str] = set()
+        self._condition = threading.Condition()
+
+    def notify(self, domain_id:str = None) -> None:
+        '''Records a notification for a domain (or every domain if None) and wakes the offenses thread.'''
+        with self._condition:
+            self._pending.add(str(domain_id) if domain_id is not None else ALL_DOMAINS)
+            self._condition.notify_all()
+
+    def wait(self, timeout:float) -> Set[str]:
+        '''Waits for notifications up to timeout seconds. After the first notification arrives, waits the coalesce window
+        to gather the rest of the burst.
+
+        :param float timeout: Max time to wait in seconds.
+        :return: Notified domains (ALL_DOMAINS if any notification did not include the domain). Empty if the timeout expired.
+        :rtype: Set[str]
+        '''
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            if not self._pending:
+                return set()
+        time.sleep(self.coalesce_window)
+        with self._condition:
+            notified, self._pending = self._pending, set()
+        return notified
+
+def parse_domain_id(value) -> str:
+    '''Returns the domain ID of a notification as a string, or None if it is missing or not a number.'''
+    try:
+        return str(int(value))
+    except (TypeError, ValueError):
+        return None
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    '''Webhook for the notifications. Accepts the domain on a JSON body ({"domain_id": 3}) or on the query string (?domain_id=3).'''
+    def do_POST(self):
+        if notification_token and not hmac.compare_digest(self.headers.get("X-Notification-Token", "").encode("utf-8"), notification_token.encode("utf-8")):
+            self.send_response(401)
+            self.end_headers()
+            return
+        domain_id = parse_domain_id(parse_qs(urlparse(self.path).query).get("domain_id", [None])[0])
+        if domain_id is None:
+            try:
+                length = min(int(self.headers.get("Content-Length") or 0), MAX_NOTIFICATION_SIZE)
+                if length > 0:
+                    body = json_codec.loads(self.rfile.read(length))
+                    domain_id = parse_domain_id(body.get("domain_id")) if isinstance(body, dict) else None
+            except Exception:
+                #Malformed notifications still wake the offenses thread for every domain
+                domain_id = None
+        notification_queue.notify(domain_id)
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        offenses_to_ibm_soar_logger.debug("Offense notification webhook: " + (format % args))
+
+class _SyslogHandler(socketserver.BaseRequestHandler):
+    '''Syslog/UDP notifications. The domain is taken from a domain_id=<id> (or domain=<id>) field of the message.'''
+    def handle(self):
+        message = self.request[0][:MAX_NOTIFICATION_SIZE].decode("utf-8", errors="replace")
+        if notification_token and notification_token not in message:
+            return
+        match = DOMAIN_ID_PATTERN.search(message)
+        notification_queue.notify(match.group(1) if match else None)
+
+notification_queue: OffenseNotificationQueue = None
+notification_token: str = None
+
+def init_notification_listener(server_config: ServerConfig) -> OffenseNotificationQueue:
+    '''Starts the webhook and/or syslog listeners enabled on the config.ini file.
+
+    :param ServerConfig server_config: Configuration of the app.
+    :return: The queue of notified domains or None if notifications are disabled.
+    :rtype: OffenseNotificationQueue
+    '''
+    global notification_queue, notification_token
+    if not server_config.notifications_enabled:
+        return None
+    notification_queue = OffenseNotificationQueue(server_config.notifications_coalesce_window)
+    notification_token = server_config.notifications_token or None
+
+    if server_config.notifications_http_port:
+        http_server = ThreadingHTTPServer((server_config.notifications_bind_address, server_config.notifications_http_port), _WebhookHandler)
+        http_server.daemon_threads = True
+        threading.Thread(target=http_server.serve_forever, name="offense_notifications_http", daemon=True).start()
+        offenses_to_ibm_soar_logger.info(f"Offense notification webhook listening on {server_config.notifications_bind_address}:{server_config.notifications_http_port}")
+    if server_config.notifications_udp_port:
+        udp_server = socketserver.ThreadingUDPServer((server_config.notifications_bind_address, server_config.notifications_udp_port), _SyslogHandler)
+        udp_server.daemon_threads = True
+        threading.Thread(target=udp_server.serve_forever, name="offense_notifications_udp", daemon=True).start()
+        offenses_to_ibm_soar_logger.info(f"Offense notification syslog/UDP listener on {server_config.notifications_bind_address}:{server_config.notifications_udp_port}")
+    return notification_queue
@@ -0,0 +1,303 @@
+'''On-demand profiling of the running app. Profiling sessions and tracemalloc snapshots are started/stopped at runtime
+(SIGUSR1/SIGUSR2 or the local admin socket) and the results are written on the logs folder. Nothing is sampled or traced while disabled.'''
+import cProfile
+import io
+import os
+import pstats
+import signal
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from app_config import ServerConfig, app_bootstrap_logger
+
+PROFILING_MODES = ("sampling", "cprofile")
+
+class ProfilingController:
+    '''Controls the profiling sessions and tracemalloc snapshots of the app.
+
+    - sampling mode: a background thread samples the stacks of every thread (both worker threads included) periodically.
+    - cprofile mode: every worker thread profiles its own loop iterations with cProfile (see profiled_iteration()) and the stats are merged when the session stops.
+      Only on Python 3.11 or earlier (app_config falls back to sampling on later versions, where cProfile profiles the whole process).
+    '''
+    def __init__(self, output_dir:str, mode:str = "sampling", sample_interval:float = 0.01, top_allocations:int = 25):
+        self.output_dir = output_dir
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.top_allocations = top_allocations
+        self.profiling_active = False
+        self._session_id = 0 #Incremented on every session, so profiles of iterations finishing after their session stopped are discarded
+        self._lock = threading.Lock()
+        self._session_start = None
+        self._sampler_thread: threading.Thread = None
+        self._sampler_stop = threading.Event()
+        self._stack_samples: Counter = Counter()
+        self._sample_count = 0
+        self._thread_profiles: list[cProfile.Profile] = []
+        self._previous_snapshot: tracemalloc.Snapshot = None
+
+    def _output_file(self, prefix:str, extension:str = "txt") -> str:
+        '''Returns a timestamped file path inside the output folder.'''
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}.{extension}")
+
+    ######## Profiling sessions ########
+
+    def start_profiling(self) -> str:
+        '''Starts a profiling session in the configured mode.
+
+        :return: Message describing the result of the operation.
+        :rtype: str
+        '''
+        with self._lock:
+            if self.profiling_active:
+                return f"A {self.mode} profiling session is already running."
+            self._session_start = time.time()
+            self._session_id += 1
+            if self.mode == "sampling":
+                self._stack_samples = Counter()
+                self._sample_count = 0
+                self._sampler_stop.clear()
+                self._sampler_thread = threading.Thread(target=self._sample_stacks, name="profiling_sampler", daemon=True)
+                self._sampler_thread.start()
+            else:
+                self._thread_profiles = []
+            self.profiling_active = True
+        app_bootstrap_logger.warning(f"Started {self.mode} profiling session.")
+        return f"Started {self.mode} profiling session."
+
+    def stop_profiling(self) -> str:
+        '''Stops the running profiling session and writes the report on the output folder.
+
+        :return: Message describing the result of the operation.
+        :rtype: str
+        '''
+        with self._lock:
+            if not self.profiling_active:
+                return "No profiling session is running."
+            self.profiling_active = False
+            duration = time.time() - self._session_start
+            if self.mode == "sampling":
+                self._sampler_stop.set()
+                self._sampler_thread.join()
+                report_file = self._write_sampling_report(duration)
+            else:
+                report_file = self._write_cprofile_report(duration)
+        app_bootstrap_logger.warning(f"Stopped {self.mode} profiling session after {duration:.1f} seconds. Report written to {report_file}")
+        return f"Profiling report written to {report_file}"
+
+    def toggle_profiling(self) -> str:
+        '''Starts a profiling session if none is running. Otherwise, stops it.'''
+        return self.stop_profiling() if self.profiling_active else self.start_profiling()
+
+    def _sample_stacks(self):
+        '''Sampler thread. Collects the stacks of every other thread until the session is stopped.'''
+        own_id = threading.get_ident()
+        while not self._sampler_stop.wait(self.sample_interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self._stack_samples[";".join(reversed(stack))] += 1
+            self._sample_count += 1
+
+    def _write_sampling_report(self, duration:float) -> str:
+        '''Writes the sampled stacks. The top functions are listed first and the collapsed stacks (flamegraph.pl/speedscope format) after them.'''
+        self_samples = Counter()
+        for stack, count in self._stack_samples.items():
+            frames = stack.split(";")
+            self_samples[f"[{frames[0]}] {frames[-1]}"] += count
+        report_file = self._output_file("profile_sampling")
+        with open(report_file, 'w') as file:
+            file.write(f"Sampling profile. Duration: {duration:.1f}s. Sampling rounds: {self._sample_count}. Interval: {self.sample_interval}s\n\n")
+            file.write("Top frames by samples ([thread] file:function:line):\n")
+            for frame, count in self_samples.most_common(50):
+                file.write(f"{count:8d}  {frame}\n")
+            file.write("\nCollapsed stacks:\n")
+            for stack, count in self._stack_samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return report_file
+
+    @contextmanager
+    def profiled_iteration(self):
+        '''Profiles the wrapped block with cProfile on the calling thread while a cprofile session is running.'''
+        if not (self.profiling_active and self.mode == "cprofile"):
+            yield
+            return
+        session_id = self._session_id
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:
+            #Another profiler may already be running on the thread. The iteration runs without profiling.
+            app_bootstrap_logger.debug(f"Could not profile the iteration of thread {threading.current_thread().name}: {str(e)}")
+            profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    if self.profiling_active and self._session_id == session_id:
+                        self._thread_profiles.append(profile)
+
+    def _write_cprofile_report(self, duration:float) -> str:
+        '''Merges the cProfile stats collected by every thread and writes them in text and pstats formats.'''
+        report_file = self._output_file("profile_cprofile")
+        if not self._thread_profiles:
+            with open(report_file, 'w') as file:
+                file.write(f"cProfile session of {duration:.1f}s. No worker iteration finished while the session was running.\n")
+            return report_file
+        stream = io.StringIO()
+        stats = pstats.Stats(self._thread_profiles[0], stream=stream)
+        for profile in self._thread_profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(report_file.replace(".txt", ".pstats"))
+        stats.sort_stats("cumulative").print_stats(50)
+        with open(report_file, 'w') as file:
+            file.write(f"cProfile session of {duration:.1f}s. Profiled iterations: {len(self._thread_profiles)}\n")
+            file.write(stream.getvalue())
+        self._thread_profiles = []
+        return report_file
+
+    ######## Memory snapshots ########
+
+    def start_tracemalloc(self) -> str:
+        '''Starts tracing memory allocations.'''
+        if tracemalloc.is_tracing():
+            return "tracemalloc is already tracing."
+        self._previous_snapshot = None
+        tracemalloc.start(10)
+        app_bootstrap_logger.warning("Started tracemalloc.")
+        return "Started tracemalloc."
+
+    def dump_tracemalloc(self) -> str:
+        '''Takes a tracemalloc snapshot and writes the top allocations (and the difference with the previous snapshot, if any).'''
+        if not tracemalloc.is_tracing():
+            return "tracemalloc is not tracing. Start it first."
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        report_file = self._output_file("tracemalloc")
+        with open(report_file, 'w') as file:
+            file.write(f"Traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\n")
+            file.write(f"Top {self.top_allocations} allocations by line:\n")
+            for stat in snapshot.statistics("lineno")[:self.top_allocations]:
+                file.write(f"{stat}\n")
+            if self._previous_snapshot is not None:
+                file.write(f"\nTop {self.top_allocations} differences with the previous snapshot:\n")
+                for stat in snapshot.compare_to(self._previous_snapshot, "lineno")[:self.top_allocations]:
+                    file.write(f"{stat}\n")
+        self._previous_snapshot = snapshot
+        app_bootstrap_logger.warning(f"tracemalloc snapshot written to {report_file}")
+        return f"tracemalloc snapshot written to {report_file}"
+
+    def stop_tracemalloc(self) -> str:
+        '''Stops tracing memory allocations.'''
+        if not tracemalloc.is_tracing():
+            return "tracemalloc is not tracing."
+        tracemalloc.stop()
+        self._previous_snapshot = None
+        app_bootstrap_logger.warning("Stopped tracemalloc.")
+        return "Stopped tracemalloc."
+
+    def toggle_tracemalloc(self) -> str:
+        '''Starts tracemalloc if not tracing. Otherwise, dumps a last snapshot and stops it.'''
+        if not tracemalloc.is_tracing():
+            return self.start_tracemalloc()
+        result = self.dump_tracemalloc()
+        self.stop_tracemalloc()
+        return result
+
+    def status(self) -> str:
+        '''Returns the status of the profiling session and tracemalloc.'''
+        return f"profiling: {'running' if self.profiling_active else 'stopped'} (mode {self.mode}), tracemalloc: {'tracing' if tracemalloc.is_tracing() else 'stopped'}"
+
+    def run_command(self, command:str) -> str:
+        '''Runs an admin command. Accepted commands: profile start|stop, tracemalloc start|snapshot|stop, status.'''
+        commands = {
+            "profile start": self.start_profiling,
+            "profile stop": self.stop_profiling,
+            "tracemalloc start": self.start_tracemalloc,
+            "tracemalloc snapshot": self.dump_tracemalloc,
+            "tracemalloc stop": self.stop_tracemalloc,
+            "status": self.status,
+        }
+        action = commands.get(" ".join(command.lower().split()))
+        if action is None:
+            return "Unknown command. Use one of: " + ", ".join(commands)
+        try:
+            return action()
+        except Exception as e:
+            app_bootstrap_logger.error(f"Error running profiling command '{command}': {str(e)}")
+            return f"Error: {str(e)}"
+
+class _AdminCommandHandler(socketserver.StreamRequestHandler):
+    '''Handles one line based admin connection. Every line is a command and gets a single line answer.'''
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode("utf-8", errors="replace").strip()
+            if not command:
+                continue
+            if command.lower() in ("quit", "exit"):
+                break
+            self.wfile.write((profiling_controller.run_command(command) + "\n").encode("utf-8"))
+
+class _AdminServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+profiling_controller: ProfilingController = None
+
+@contextmanager
+def profiled_iteration():
+    '''Wraps a worker loop iteration. Costs a single attribute check unless a cprofile session is running.'''
+    if profiling_controller is None or not profiling_controller.profiling_active:
+        yield
+        return
+    with profiling_controller.profiled_iteration():
+        yield
+
+def _run_in_background(action):
+    '''Returns a signal handler that runs the action in a separate thread, so that no file is written inside the signal handler itself.'''
+    def handler(signum, frame):
+        threading.Thread(target=action, name="profiling_signal", daemon=True).start()
+    return handler
+
+def init_profiling(server_config: ServerConfig) -> ProfilingController:
+    '''Creates the profiling controller and registers the signal handlers and admin socket enabled on the config.ini file.
+    Must be called from the main thread (signal handlers can only be set there).
+
+    :param ServerConfig server_config: Configuration of the app.
+    :return: The profiling controller
+    :rtype: ProfilingController
+    '''
+    global profiling_controller
+    profiling_controller = ProfilingController(server_config.profiling_output_dir, server_config.profiling_mode,
+                                               server_config.profiling_sample_interval, server_config.profiling_top_allocations)
+
+    if server_config.profiling_signals_enabled:
+        if hasattr(signal, "SIGUSR1") and hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR1, _run_in_background(profiling_controller.toggle_profiling))
+            signal.signal(signal.SIGUSR2, _run_in_background(profiling_controller.toggle_tracemalloc))
+            app_bootstrap_logger.info(f"Profiling signals registered. Send SIGUSR1 (profiling) or SIGUSR2 (tracemalloc) to PID {os.getpid()}.")
+        else:
+            app_bootstrap_logger.warning("SIGUSR1/SIGUSR2 are not available on this platform. Use the profiling admin socket instead.")
+
+    if server_config.profiling_admin_port:
+        server = _AdminServer(("127.0.0.1", server_config.profiling_admin_port), _AdminCommandHandler)
+        threading.Thread(target=server.serve_forever, name="profiling_admin_socket", daemon=True).start()
+        app_bootstrap_logger.info(f"Profiling admin socket listening on 127.0.0.1:{server_config.profiling_admin_port}")
+
+    return profiling_controller
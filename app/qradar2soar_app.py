@@ -1,7 +1,10 @@
 import threading
-from qradar_siem_offenses_to_soar import main as offenses_to_soar_run
+from qradar_siem_offenses_to_soar import init_escalation_outbox, main as offenses_to_soar_run
 from reupload_failed_offenses_to_soar import main as retry_uploading_failed_offenses_run
 from app_config import server_config
+from profiling_hooks import init_profiling
+from lease_coordination import init_coordination
+from offense_notification_listener import init_notification_listener
 
 def send_offense_to_soar(server_config):
     '''Calls the main method for the send offenses to SOAR Python module, which runs in a separate thread.
@@ -18,8 +21,13 @@ def retry_uploading_failed_offenses_to_soar(server_config):
 
 def main():
     '''Main method. Runs both threads (offenses and failed offenses) in daemon mode. '''
-    t1 = threading.Thread(target=send_offense_to_soar, args=(server_config,), daemon=True)
-    t2 = threading.Thread(target=retry_uploading_failed_offenses_to_soar , args=(server_config,), daemon=True)
+    init_profiling(server_config)
+    coordinator = init_coordination(server_config, server_config.siem_domains)
+    #Fails before starting the threads if another process is using the outbox of this instance
+    init_escalation_outbox(server_config)
+    init_notification_listener(server_config)
+    t1 = threading.Thread(target=send_offense_to_soar, args=(server_config,), name="offenses_to_soar", daemon=True)
+    t2 = threading.Thread(target=retry_uploading_failed_offenses_to_soar , args=(server_config,), name="failed_offenses_to_soar", daemon=True)
     
     t1.start()
     t2.start()
@@ -33,6 +41,8 @@ def main():
             t2.join(timeout=1)
     except KeyboardInterrupt:
         print("Program interrupted! Exiting...")  
+        if coordinator is not None:
+            coordinator.stop()
 
 
     # t1.start()
@@ -1,14 +1,33 @@
 import requests
+import heapq
+import logging
 import time
 import os
-import json
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+import json_codec
+import lease_coordination
+from durable_files import interprocess_file_lock, write_file_atomically
+import offense_notification_listener
+from fair_offense_scheduler import FairOffenseScheduler
+from escalation_outbox import DONE, SENDING, EscalationOutbox
+from dead_letter_store import add_dead_letter_offense
+from escalation_errors import PermanentEscalationError, ReconciliationError, describe_failure, is_permanent_failure
 from app_config import ServerConfig, offenses_to_ibm_soar_logger
+from profiling_hooks import profiled_iteration
 
 
 qradar_headers = {'SEC': None, 'Accept': 'application/json'} #Headers for QRadar API. Paritally obtained from config.ini file
 config: ServerConfig = None
 available_domains: List[str] = []
+qradar_query_executor: ThreadPoolExecutor = None #Runs the domain filter chunks concurrently
+MAX_FETCHES_PER_WAKE_UP = 20 #Max offense fetches in a row (backlog or notification) before waiting again
+UNKNOWN_SOAR_ORG = "unknown" #Scheduler queue of the offenses of domains without a customer configured (they fail permanently)
+offenses_scheduler: FairOffenseScheduler = None #Per SOAR organization queues between the fetch of the offenses and their post to SOAR
+failed_offenses_file_lock = threading.Lock() #Shared with the failed offenses reupload thread, both threads edit the failed offenses file
+escalation_outbox: EscalationOutbox = None #Write-ahead record of the queued offenses and the posts to SOAR, used to resume after a restart
 
 def load_last_processed_id()-> int:
     """Load the last processed offense ID from a file.
@@ -29,11 +48,177 @@ def save_last_processed_id(offense_id:int) -> None:
     :return: Nothing.
     :rtype: None
     :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the file"""
-    with open(config.last_escalated_offense_file, 'w') as file:
-        file.write(str(offense_id))
+    write_file_atomically(config.last_escalated_offense_file, str(offense_id))
     global last_processed_id
     last_processed_id = offense_id
 
+def load_domain_checkpoints() -> Dict[str,int]:
+    """Load the last processed offense ID of every domain this instance escalates. Without coordination every configured domain starts from the
+    last processed offense ID file. With coordination only the domains leased by this instance are returned, with the checkpoints from the lease store.
+
+    :return: Dict with the domain IDs as keys and the last processed offense ID of each one as values.
+    :rtype: Dict[str,int]
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/reading the file
+    """
+    global last_processed_id
+    last_processed_id = load_last_processed_id()
+    if not last_processed_id:
+        raise Exception("ERROR! Provide a minimum Offense ID on the Offense ID index File!")
+    coordinator = lease_coordination.coordinator
+    if coordinator is None:
+        return {domain: last_processed_id for domain in available_domains}
+    return coordinator.get_checkpoints(sorted(coordinator.owned_partitions()), last_processed_id)
+
+def save_checkpoint(domain_id:str, offense_id:int) -> None:
+    """Save an offense ID as the last processed one. On the last processed offense ID file or, with coordination, on the lease store checkpoint of the domain.
+
+    :param str domain_id: Domain of the checkpoint (only used with coordination).
+    :param int offense_id: The last processed offense ID.
+    :return: Nothing.
+    :rtype: None
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the file"""
+    coordinator = lease_coordination.coordinator
+    if coordinator is None:
+        save_last_processed_id(offense_id)
+    elif not coordinator.save_checkpoint(domain_id, offense_id):
+        offenses_to_ibm_soar_logger.warning(f"Lease of domain {domain_id} lost before saving the checkpoint of offense {offense_id}. The new owner of the domain will continue from its last checkpoint.")
+        return
+    if escalation_outbox is not None:
+        escalation_outbox.checkpoint_saved(domain_id, offense_id)
+
+def checkpoint_key(domain_id) -> str:
+    """Returns the checkpoint an offense domain belongs to: the domain itself with coordination, None (the single last processed ID file) without it."""
+    return str(domain_id) if lease_coordination.coordinator is not None else None
+
+class CheckpointTracker:
+    """Tracks the offenses fetched but not processed yet (queued or being posted) of every checkpoint, and the fetch cursor (highest offense ID
+    fetched or known to not exist) of every domain. Domains are fetched from their own cursor, so a domain left out of a fetch (its SOAR
+    organization queue is full) does not hold back the others. Checkpoints never move past a pending offense nor past the cursor of any of their
+    domains. Resetting a checkpoint (lease lost) drops its pending offenses: they are fetched again, from the persisted checkpoint, by the new owner of the domain."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors: Dict[str,int] = {}
+        self._domains: Dict[str,set] = {}
+        self._pending: Dict[str,set] = {}
+        self._saved: Dict[str,int] = {}
+        self._generations: Dict[str,int] = {}
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._domains)
+
+    def fetch_checkpoint(self, key:str, domain_id:str, persisted_checkpoint:int) -> int:
+        """Registers a domain of a checkpoint and returns the offense ID to fetch it after: the persisted checkpoint or the cursor of the domain."""
+        with self._lock:
+            #The checkpoint is never saved below the persisted one (offenses recovered from the outbox are tracked from it)
+            self._saved[key] = max(persisted_checkpoint, self._saved.get(key, persisted_checkpoint))
+            self._domains.setdefault(key, set()).add(domain_id)
+            self._cursors[domain_id] = max(persisted_checkpoint, self._cursors.get(domain_id, persisted_checkpoint))
+            return self._cursors[domain_id]
+
+    def track(self, key:str, offense_id:int) -> int:
+        """Registers a fetched offense as pending. Returns the generation of the checkpoint, to be passed to complete()."""
+        with self._lock:
+            self._pending.setdefault(key, set()).add(offense_id)
+            return self._generations.get(key, 0)
+
+    def advance(self, key:str, domain_id:str, offense_id:int) -> None:
+        """Moves the cursor of a domain: every offense of the domain up to offense_id was fetched (and tracked) or does not exist."""
+        with self._lock:
+            self._domains.setdefault(key, set()).add(domain_id)
+            self._cursors[domain_id] = max(offense_id, self._cursors.get(domain_id, offense_id))
+
+    def highest_cursor(self) -> int:
+        """Returns the highest cursor of every domain (an offense ID known to exist), or -1 if no domain was fetched."""
+        with self._lock:
+            return max(self._cursors.values(), default=-1)
+
+    def is_current(self, key:str, generation:int) -> bool:
+        """False if the checkpoint was reset after the offense was fetched."""
+        with self._lock:
+            return self._generations.get(key, 0) == generation
+
+    def complete(self, key:str, offense_id:int, generation:int) -> None:
+        """Marks an offense as processed and saves the checkpoint if it moved (every offense up to it is processed)."""
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return
+            pending = self._pending.get(key, set())
+            pending.discard(offense_id)
+            checkpoint = min((self._cursors[domain_id] for domain_id in self._domains.get(key, ())), default=self._saved.get(key, -1))
+            if pending:
+                checkpoint = min(checkpoint, min(pending) - 1)
+            if checkpoint > self._saved.get(key, -1):
+                #Saved while holding the lock, so concurrent workers never write an older checkpoint over a newer one
+                save_checkpoint(key, checkpoint)
+                self._saved[key] = checkpoint
+
+    def reset(self, key:str) -> None:
+        """Forgets the cursors and pending offenses of a checkpoint."""
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            for domain_id in self._domains.pop(key, set()):
+                self._cursors.pop(domain_id, None)
+            self._pending.pop(key, None)
+            self._saved.pop(key, None)
+
+checkpoint_tracker = CheckpointTracker()
+
+class InFlightPosts:
+    """Counts the posts to SOAR in progress per domain. Domains being released (lease rebalance) are closed: no new post starts on them
+    and the release waits for the ones in progress, so their checkpoints are saved while the lease is still held."""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._posts: Dict[str,int] = {}
+        self._closed: set = set()
+
+    def start(self, domain_id:str) -> bool:
+        """Registers a post of the domain. False if the domain is being released (the post must not start)."""
+        with self._condition:
+            if domain_id in self._closed:
+                return False
+            self._posts[domain_id] = self._posts.get(domain_id, 0) + 1
+            return True
+
+    def finish(self, domain_id:str) -> None:
+        with self._condition:
+            self._posts[domain_id] -= 1
+            self._condition.notify_all()
+
+    def close_and_wait(self, domain_ids:List[str], timeout:float) -> bool:
+        """Closes the domains and waits for their posts in progress. Returns False if the timeout expired first."""
+        with self._condition:
+            self._closed.update(domain_ids)
+            return self._condition.wait_for(lambda: not any(self._posts.get(domain_id, 0) for domain_id in domain_ids), timeout)
+
+    def reopen(self, domain_ids:List[str]) -> None:
+        with self._condition:
+            self._closed.difference_update(domain_ids)
+
+in_flight_posts = InFlightPosts()
+
+def forget_checkpoints(keys:List[str]) -> None:
+    """Forgets the offenses of checkpoints whose domains were released or lost: their pending offenses on the tracker and their outbox entries.
+    The new owner of the domains fetches them again from the stored checkpoint and checks the posts started here on SOAR (lease store posts)."""
+    for key in keys:
+        checkpoint_tracker.reset(key)
+    if escalation_outbox is not None:
+        escalation_outbox.forget(keys)
+
+def release_domains(domain_ids:List[str]) -> None:
+    """Called by the lease coordinator (holding the work lock) before releasing domains to another instance. Waits for the posts in progress of
+    the domains, so their checkpoints are saved before the new owner reads them, and forgets their queued offenses (the new owner fetches them)."""
+    if not in_flight_posts.close_and_wait(domain_ids, lease_coordination.coordinator.lease_ttl / 2):
+        offenses_to_ibm_soar_logger.warning(f"Posts to SOAR of domains {domain_ids} still in progress when releasing them. Their offenses may be escalated again by the new owner.")
+    forget_checkpoints([checkpoint_key(domain_id) for domain_id in domain_ids])
+    in_flight_posts.reopen(domain_ids)
+
+@contextmanager
+def failed_offenses_file_guard():
+    """Locks the failed offenses file between the threads of this instance and between processes (other instances sharing it and the requeue command)."""
+    with failed_offenses_file_lock, interprocess_file_lock(config.failed_escalations_offenses_file):
+        yield
+
 def save_failed_offense_creation_on_soar(offense_id_that_failed:int) -> None:
     """Appends a numeric offense ID the failed SOAR uploaded offenses file, separated by commas.
 
@@ -41,28 +226,127 @@ def save_failed_offense_creation_on_soar(offense_id_that_failed:int) -> None:
     :return: Nothing.
     :rtype: None
     :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the file"""
-    with open(config.failed_escalations_offenses_file, 'a') as file:
-        if file.tell() > 0:  # Check if the file is not empty
-            file.write(',')
-        file.write(str(offense_id_that_failed))
+    with failed_offenses_file_guard():
+        ids = load_failed_offense_ids()
+        write_file_atomically(config.failed_escalations_offenses_file, ",".join(ids + [str(offense_id_that_failed)]))
 
-def get_latest_offenses() -> List[Dict[any,any]]:
-    #filterout in query the controlled domains
+def load_failed_offense_ids() -> List[str]:
+    """Load the IDs stored on the failed SOAR uploaded offenses file.
+
+    :return: List of the IDs on the file (as strings).
+    :rtype: List[str]
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/reading the file"""
+    if os.path.exists(config.failed_escalations_offenses_file):
+        with open(config.failed_escalations_offenses_file, 'r') as file:
+            return [id_str.strip() for id_str in file.read().split(",") if id_str.strip() != ""]
+    return []
+
+def save_failed_offense(offense_id:int, error:Exception, logger) -> None:
+    """Stores an offense that failed to be escalated. Permanent failures go to the dead-letter store (with the error payload) and
+    transient ones to the failed offenses file to be retried.
 
-    """Retrieve the latest offense from QRadar. Filtering by status as OPEN, the ID being bigger than the offset ID of the last processed ID from QRADAR, and filtering by start_time in ascendant mode to get the latest one.
+    :param int offense_id: The ID of the offense that failed to be uploaded to IBM SOAR.
+    :param Exception error: The exception raised when escalating the offense.
+    :param Logger logger: Logger of the thread that failed escalating the offense.
+    :return: Nothing.
+    :rtype: None
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the files"""
+    if is_permanent_failure(error):
+        logger.error(f"Offense with ID {str(offense_id)} failed permanently. Moving it to the dead-letter store. It will not be retried until it is requeued.")
+        add_dead_letter_offense(config.dead_letter_offenses_file, offense_id, describe_failure(error), logger.name)
+    else:
+        save_failed_offense_creation_on_soar(offense_id)
+
+def build_offense_filter(domain_checkpoints:Dict[str,int]) -> str:
+    """Builds the QRADAR filter for the open offenses newer than the checkpoint of their domain. Domains sharing the same checkpoint are grouped in a single clause.
+
+    :param Dict[str,int] domain_checkpoints: Last processed offense ID of each domain.
+    :return: QRADAR API filter.
+    :rtype: str"""
+    domains_by_checkpoint: Dict[int,List[str]] = {}
+    for domain, checkpoint in domain_checkpoints.items():
+        domains_by_checkpoint.setdefault(checkpoint, []).append(str(domain))
+    clauses = ["id > " + str(checkpoint) + " and domain_id in (" + ",".join(domains) + ")" for checkpoint, domains in domains_by_checkpoint.items()]
+    if len(clauses) == 1:
+        return "status=OPEN and " + clauses[0]
+    return "status=OPEN and (" + " or ".join("(" + clause + ")" for clause in clauses) + ")"
+
+def build_offense_filter_chunks(domain_checkpoints:Dict[str,int], chunk_size:int, max_length:int) -> List[str]:
+    """Splits the domains in chunks and builds the QRADAR filter of each chunk, so no filter exceeds the practical query length of QRADAR.
+    A chunk is closed when it has chunk_size domains or when the next domain would make its filter longer than max_length characters
+    (domains with their own checkpoint need a clause each, so they take much more space than domains sharing a checkpoint).
+    Domains are sorted by checkpoint first, so domains sharing a checkpoint end up in the same clause.
+
+    :param Dict[str,int] domain_checkpoints: Last processed offense ID of each domain.
+    :param int chunk_size: Max number of domains per filter.
+    :param int max_length: Max number of characters per filter (a single domain whose clause is longer gets its own filter).
+    :return: List of QRADAR API filters.
+    :rtype: List[str]"""
+    empty_filter_length = len("status=OPEN and ()")
+    chunks: List[str] = []
+    chunk: Dict[str,int] = {}
+    length = empty_filter_length
+    last_checkpoint = None
+    for domain, checkpoint in sorted(domain_checkpoints.items(), key=lambda item: (item[1], item[0])):
+        #Characters added by the domain: ",<domain>" on the clause of its checkpoint, or a new " or (id > <checkpoint> and domain_id in (<domain>))" clause
+        new_clause = checkpoint != last_checkpoint
+        added = len(str(domain)) + (len(f" or (id > {checkpoint} and domain_id in ())") if new_clause else 1)
+        if chunk and (len(chunk) >= chunk_size or length + added > max_length):
+            chunks.append(build_offense_filter(chunk))
+            chunk, length = {}, empty_filter_length
+            added = len(str(domain)) + len(f" or (id > {checkpoint} and domain_id in ())")
+        chunk[domain] = checkpoint
+        length += added
+        last_checkpoint = checkpoint
+    if chunk:
+        chunks.append(build_offense_filter(chunk))
+    return chunks
+
+def fetch_offenses(offense_filter:str) -> List[Dict[any,any]]:
+    """Retrieve the first offenses (lowest IDs, up to the fetch batch size) matching a filter from QRadar.
+
+    :param str offense_filter: QRADAR API filter.
     :return: JSON response of the offenses obtained.
-    :rtype: Dict[any,any]
+    :rtype: List[Dict[any,any]]
     :raises HttpError: if an error occurred making the HTTP request"""
-
-    domains = ",".join(available_domains)  
-    params = { "filter": 'status=OPEN and id > ' + str(last_processed_id) + " and domain_id in (" + domains + ")", "sort": "+start_time"  }
-    global qradar_headers
-    qradar_headers = qradar_headers.copy()
-    qradar_headers["RANGE"] = "items=0-0"
-    qradar_headers["VERSION"] = "20.0"
-    response = requests.get(config.qradar_url, headers=qradar_headers, verify=False, params=params)
+    params = { "filter": offense_filter, "sort": "+id"  }
+    headers = dict(qradar_headers, RANGE=f"items=0-{config.offenses_fetch_batch_size - 1}", VERSION="20.0")
+    response = requests.get(config.qradar_url, headers=headers, verify=False, params=params)
     response.raise_for_status()
-    return response.json()
+    return json_codec.decode_response(response)
+
+def get_latest_offenses(domain_checkpoints:Dict[str,int]) -> List[Dict[any,any]]:
+    #filterout in query the controlled domains
+
+    """Retrieve the latest offenses from QRadar. Filtering by status as OPEN, the ID being bigger than the offset ID of the last processed ID of its domain from QRADAR, and sorting by ID in ascendant mode to get the next ones.
+    Big domain sets are split in filter chunks queried concurrently, and their results are merged in ID order.
+    :param Dict[str,int] domain_checkpoints: Last processed offense ID of each domain to query.
+    :return: JSON response of the offenses obtained.
+    :rtype: List[Dict[any,any]]
+    :raises HttpError: if an error occurred making the HTTP request on any of the chunks"""
+    return fetch_latest_offenses(domain_checkpoints)[0]
+
+def fetch_latest_offenses(domain_checkpoints:Dict[str,int]) -> Tuple[List[Dict[any,any]], bool]:
+    """Same as get_latest_offenses, also telling if every offense of the queried domains was obtained (no chunk returned a full batch).
+
+    :param Dict[str,int] domain_checkpoints: Last processed offense ID of each domain to query.
+    :return: Tuple with the offenses obtained and True if no offense of the queried domains was left for the next fetch.
+    :rtype: Tuple[List[Dict[any,any]],bool]
+    :raises HttpError: if an error occurred making the HTTP request on any of the chunks"""
+    offense_filters = build_offense_filter_chunks(domain_checkpoints, config.qradar_domain_filter_chunk_size, config.qradar_filter_max_length)
+    if len(offense_filters) == 1:
+        offenses = fetch_offenses(offense_filters[0])
+        return offenses, len(offenses) < config.offenses_fetch_batch_size
+    #Every chunk must succeed. Otherwise, the checkpoint could move past offenses of the failed chunk.
+    results = list(qradar_query_executor.map(fetch_offenses, offense_filters))
+    offenses = list(heapq.merge(*results, key=lambda offense: offense.get('id', 0)))
+    #A full chunk may have more offenses after its last one. Offenses of the other chunks after that ID are left for the next fetch,
+    #so the highest fetched ID never jumps over an offense that was not fetched yet.
+    full_chunks_last_ids = [chunk[-1].get('id', 0) for chunk in results if len(chunk) >= config.offenses_fetch_batch_size]
+    if full_chunks_last_ids:
+        cutoff = min(full_chunks_last_ids)
+        offenses = [offense for offense in offenses if offense.get('id', 0) <= cutoff]
+    return offenses, not full_chunks_last_ids
 
 def map_severity(severity_quantity):
     '''Maps the SIEM severity with the accepted SOAR severity'''
@@ -79,14 +363,12 @@ def map_severity(severity_quantity):
 def get_org_id_from_qradar_domain_and_credentials(offense):
     '''Gets the SOAR org id from the QRADAR domain'''
     if (offense and offense.get("domain_id",-999) > -1):
-        for el in config.customer_configurations:
-            # print(config.customer_configurations.get(el,{}).get("siem_org_id", ""))
-            # print(str(offense.get("domain_id")))
-            if str(config.customer_configurations.get(el,{}).get("siem_org_id", "")) == str(offense.get("domain_id")):
-                return {"soar_org": config.customer_configurations.get(el,{}).get("soar_org_id", ""), "soar_auth": config.customer_configurations.get(el,{}).get("soar_api_key_auth","")}
-        raise Exception ("No domain found on the config.ini file matching the domain of the offense to escalate")
+        customer = config.customer_configurations_by_domain.get(str(offense.get("domain_id")))
+        if customer:
+            return {"soar_org": customer.get("soar_org_id", ""), "soar_auth": customer.get("soar_api_key_auth","")}
+        raise PermanentEscalationError("No domain found on the config.ini file matching the domain of the offense to escalate")
     else:
-        raise Exception("No domain ID assigned to the offense")
+        raise PermanentEscalationError("No domain ID assigned to the offense")
     
 def generate_artifacts(offense):
     '''Generate an array of SOAR artifacts from an offense artifacts'''
@@ -168,72 +450,219 @@ def generate_artifacts(offense):
     else:
         return []
 
+def build_soar_incident_body(offense):
+    '''Builds the IBM SOAR incident body from a QRADAR offense'''
+    return {
+        "discovered_date": offense.get("start_time", int(time.time() * 1000)),
+        "description": str(offense.get("event_count", "0")) + " events in " + str(offense.get("category_count", "0")) + " categories: " + offense.get("description"),
+        "confirmed": "false",
+        "start_date": offense.get("start_time", int(time.time() * 1000)),
+        "incident_type_ids": ["System Intrusion"],
+        "severity_code": map_severity(offense.get("severity",5)),
+        "name": f"QRADAR ID { str(offense.get('id', '0')) } , { offense.get('description', '') } - {offense.get('offense_source', '')}",
+        "artifacts": generate_artifacts(offense)
+    }
+
+def post_to_soar(soar_mapping, path:str, payload):
+    '''Posts a JSON payload to an IBM SOAR organization endpoint and returns the decoded response'''
+    #The body is serialized only once here and sent as raw bytes (optionally gzip compressed).
+    try:
+        body, encoding_headers = json_codec.encode_body(payload, config.soar_gzip_requests)
+    except (TypeError, ValueError) as e:
+        raise PermanentEscalationError(f"Error serializing the SOAR request body: {str(e)}") from e
+
+    headers = {'Accept': 'application/json' , 'Content-Type': 'application/json' , "Authorization": "Basic " + soar_mapping.get("soar_auth","")}
+    headers.update(encoding_headers)
+    url_=config.soar_url + "/" + soar_mapping.get("soar_org","") + path
+    response = requests.post(url = url_, data = body, headers=headers, verify=False)
+    response.raise_for_status()
+    return json_codec.decode_response(response)
+
 def create_offense_in_soar(offense):
     if (offense):
         soar_mapping = get_org_id_from_qradar_domain_and_credentials(offense)
         # print(soar_mapping)
-        body = {
-            "discovered_date": offense.get("start_time", int(time.time() * 1000)),
-            "description": str(offense.get("event_count", "0")) + " events in " + str(offense.get("category_count", "0")) + " categories: " + offense.get("description"),
-            "confirmed": "false",
-            "start_date": offense.get("start_time", int(time.time() * 1000)),
-            "incident_type_ids": ["System Intrusion"],
-            "severity_code": map_severity(offense.get("severity",5)),
-            "name": f"QRADAR ID { str(offense.get('id', '0')) } , { offense.get('description', '') } - {offense.get('offense_source', '')}",
-            "artifacts": generate_artifacts(offense)
-        }
-
-        # print(json.dumps(body))
-
-        headers = {'Accept': 'application/json' , 'Content-Type': 'application/json' , "Authorization": "Basic " + soar_mapping.get("soar_auth","")}
-        # print(headers)
-        url_=config.soar_url + "/" + soar_mapping.get("soar_org","") + "/incidents"
-        # print(url_)
-        bod = json.dumps(body)
-        # print(bod)
-        response = requests.post(url = url_, json = body, headers=headers, verify=False)
-        response.raise_for_status()
-        return response.json()
+        try:
+            body = build_soar_incident_body(offense)
+        except Exception as e:
+            #The same offense will always build the same invalid body
+            raise PermanentEscalationError(f"Error building the SOAR incident body of the offense: {str(e)}") from e
+        return post_to_soar(soar_mapping, "/incidents", body)
     else:
-        raise Exception ("Error. No offense to create SOAR incident/case!")
+        raise PermanentEscalationError("Error. No offense to create SOAR incident/case!")
+
+def find_offense_in_soar(offense):
+    '''Looks for the SOAR incident of an offense by the QRADAR ID on its name. Used before posting again an offense whose previous post
+    may have reached SOAR (interrupted by a crash or failed with a timeout). Returns the incident or None if it was not created.
+    Query errors raise ReconciliationError (transient), so an API key that can not query incidents never dead-letters the offense.'''
+    soar_mapping = get_org_id_from_qradar_domain_and_credentials(offense)
+    name_prefix = f"QRADAR ID { str(offense.get('id', '0')) } ,"
+    query = {"filters": [{"conditions": [{"field_name": "name", "method": "contains", "value": name_prefix}]}], "start": 0, "length": 10}
+    try:
+        response = post_to_soar(soar_mapping, "/incidents/query_paged?return_level=partial", query)
+    except Exception as e:
+        raise ReconciliationError(f"Could not check on SOAR whether offense {offense.get('id')} was already created (reconciliation unavailable). It was not posted and is kept to be retried: {str(e)}") from e
+    for incident in (response or {}).get("data", []):
+        if str(incident.get("name", "")).startswith(name_prefix):
+            return incident
+    return None
 
 def get_domains_available():
     global available_domains
-    for item in config.customer_configurations:
-        if config.customer_configurations.get(item,{}).get("siem_org_id"):
-            available_domains.append(config.customer_configurations.get(item,{}).get("siem_org_id"))
+    available_domains = list(config.siem_domains)
 
-def process_offense():
-    """Process the next unprocessed offense and create a SOAR offense for it."""
-    global last_processed_id
-    last_processed_id = load_last_processed_id()
-    if not last_processed_id:
-        raise Exception("ERROR! Provide a minimum Offense ID on the Offense ID index File!")
-    
-    offenses_to_ibm_soar_logger.info("Last processed Offense ID stored on memory file: " + str(last_processed_id) + " . Getting offense from QRADAR SIEM...")
-    latest_offense = get_latest_offenses()
+def get_soar_org_of_domain(domain_id) -> str:
+    """Returns the SOAR organization the offenses of a domain are escalated to (their scheduler queue)."""
+    customer = config.customer_configurations_by_domain.get(str(domain_id))
+    return str(int(customer.get("soar_org_id"))) if customer else UNKNOWN_SOAR_ORG
+
+def get_soar_org_of_offense(offense) -> str:
+    """Returns the SOAR organization an offense is escalated to (its scheduler queue)."""
+    return get_soar_org_of_domain(offense.get("domain_id"))
+
+def is_escalated_on_outbox(offense_id:int) -> bool:
+    """True if the outbox records the offense as escalated or stored as failed."""
+    entry = escalation_outbox.get(offense_id)
+    return entry is not None and entry.get("state") == DONE
+
+def fetch_and_schedule_offenses(notified_domains:set[str] = None) -> int:
+    """Fetch the next unprocessed offenses and queue them on the scheduler, to be escalated to SOAR by the post workers.
+
+    :param set[str] notified_domains: Domains notified by the offense notification listener. Only they are queried. Every domain is fetched from its own
+    cursor (even when they share the last processed ID file), so the domains left out never have their older offenses skipped.
+    :return: Number of offenses queued.
+    :rtype: int"""
+    domain_checkpoints = load_domain_checkpoints()
+    if lease_coordination.coordinator is not None:
+        #Forget the offenses fetched for domains whose lease was lost. The new owner fetches them again.
+        lost_keys = [key for key in checkpoint_tracker.keys() if key not in domain_checkpoints]
+        if lost_keys:
+            forget_checkpoints(lost_keys)
+    #Every domain is registered on its checkpoint, so the cursors of the domains not notified hold it back
+    fetch_checkpoints = {domain: checkpoint_tracker.fetch_checkpoint(checkpoint_key(domain), domain, checkpoint) for domain, checkpoint in domain_checkpoints.items()}
+    if notified_domains and offense_notification_listener.ALL_DOMAINS not in notified_domains:
+        fetch_checkpoints = {domain: checkpoint for domain, checkpoint in fetch_checkpoints.items() if domain in notified_domains}
+    if not fetch_checkpoints:
+        offenses_to_ibm_soar_logger.info("No domains leased by this instance (or notified). Waiting for the next poll.")
+        return 0
+
+    #Domains of SOAR organizations with a full queue are left out of this fetch (their cursor does not move), so a customer with a big backlog
+    #never stops the offenses of the other customers from being fetched
+    full_orgs = {org for org, queued in offenses_scheduler.queued_by_org().items() if queued >= config.max_queued_offenses_per_org}
+    if full_orgs:
+        offenses_to_ibm_soar_logger.warning(f"SOAR organizations {sorted(full_orgs)} already have {config.max_queued_offenses_per_org} or more offenses queued. Their domains are not fetched until their queues drain: {offenses_scheduler.queued_by_org()}")
+        fetch_checkpoints = {domain: checkpoint for domain, checkpoint in fetch_checkpoints.items() if get_soar_org_of_domain(domain) not in full_orgs}
+        if not fetch_checkpoints:
+            return 0
+    offenses_to_ibm_soar_logger.info("Last processed Offense ID stored on memory file: " + str(last_processed_id) + " . Getting offenses from QRADAR SIEM...")
+    latest_offenses, all_fetched = fetch_latest_offenses(fetch_checkpoints)
     offenses_to_ibm_soar_logger.info("Call succesfully made to QRADAR SIEM...")
-    offenses_to_ibm_soar_logger.debug("Offense to process and send to IBM SOAR: " + json.dumps(latest_offense))
-    # Sort offenses by ID in ascending order
-    #latest_offense.sort(key=lambda x: x.get('id',None))
+    #Serializing the whole batch is only worth it when it is logged
+    if offenses_to_ibm_soar_logger.isEnabledFor(logging.DEBUG):
+        offenses_to_ibm_soar_logger.debug("Offenses to process and send to IBM SOAR: " + json_codec.dumps_str(latest_offenses))
 
-    if (not latest_offense or len(latest_offense) == 0):
+    if (not latest_offenses or len(latest_offenses) == 0):
         offenses_to_ibm_soar_logger.info("No offenses obtained from QRADAR SIEM.")
-    #For the first offense obtained, create the SOAR case and update the file containing the last processed ID.
-    for offense in latest_offense:
+    new_offenses = []
+    for offense in latest_offenses:
         offense_id = offense.get('id', None)
-        if last_processed_id is not None and offense_id > last_processed_id:
-            offenses_to_ibm_soar_logger.info(f"Processing offense with ID. About to create it on SOAR!: {offense_id}")
-            try:
-                create_offense_in_soar(offense)
-                save_last_processed_id(offense_id)
-                pass
-            except Exception as e:
-                offenses_to_ibm_soar_logger.error(f"Exception creating SOAR incident for offense with ID: {str(offense_id)}: {str(e)}")
-                save_failed_offense_creation_on_soar(offense_id) #store the failed offense to be uploaded to soar in a file
-            break #Process only one offense at a time
+        domain_checkpoint = fetch_checkpoints.get(str(offense.get('domain_id')))
+        if domain_checkpoint is not None and offense_id > domain_checkpoint:
+            new_offenses.append((offense, checkpoint_key(offense.get('domain_id'))))
         else:
             offenses_to_ibm_soar_logger.error(f"Offense {offense_id} has already been processed. Please, increase the Offense ID offset on the file to start scanning new offenses!.")
+    #Offenses already escalated (or stored as failed) whose checkpoint was not saved yet are not escalated twice, only their checkpoint moves
+    known_offenses = [(offense, key) for offense, key in new_offenses if is_escalated_on_outbox(offense.get('id'))]
+    new_offenses = [(offense, key) for offense, key in new_offenses if not is_escalated_on_outbox(offense.get('id'))]
+    #Recorded on the outbox (flushed to disk) before queuing them, so they are not lost if the app stops before posting them
+    escalation_outbox.record_queued(new_offenses)
+    known_generations = [checkpoint_tracker.track(key, offense.get('id')) for offense, key in known_offenses]
+    new_generations = [checkpoint_tracker.track(key, offense.get('id')) for offense, key in new_offenses]
+    #Offenses come sorted by ID and cut at the first full chunk, so every offense of the queried domains up to the last one was fetched. If nothing
+    #was left, the queried domains have no offense up to the highest ID known to exist either (offense IDs only grow).
+    #The cursors move only after the offenses are tracked, so a checkpoint never passes an offense not queued yet.
+    fetched_up_to = latest_offenses[-1].get('id') if latest_offenses else None
+    if all_fetched:
+        fetched_up_to = max(checkpoint_tracker.highest_cursor(), fetched_up_to or 0)
+    if fetched_up_to is not None:
+        for domain in fetch_checkpoints:
+            checkpoint_tracker.advance(checkpoint_key(domain), domain, fetched_up_to)
+    for (offense, key), generation in zip(known_offenses, known_generations):
+        checkpoint_tracker.complete(key, offense.get('id'), generation)
+    #Offenses whose post was started by a previous owner of their domain (taken over after it died) may already be on SOAR. They are checked before posting them.
+    started_posts = lease_coordination.coordinator.get_started_posts(fetch_checkpoints) if lease_coordination.coordinator is not None and new_offenses else set()
+    queued = 0
+    for (offense, key), generation in zip(new_offenses, new_generations):
+        offenses_scheduler.submit(get_soar_org_of_offense(offense), (offense, key, generation, offense.get('id') in started_posts))
+        queued += 1
+    if queued:
+        offenses_to_ibm_soar_logger.info(f"Queued {queued} offenses to be escalated to IBM SOAR. Queued offenses by SOAR organization: {offenses_scheduler.queued_by_org()}")
+    return queued
+
+def process_offense(offense:Dict[any,any], key:str, generation:int, reconcile:bool = False) -> None:
+    """Create a SOAR offense for an offense taken from the scheduler and move its checkpoint.
+
+    :param Dict offense: Offense to escalate.
+    :param str key: Checkpoint of the offense (see checkpoint_key()).
+    :param int generation: Generation of the checkpoint when the offense was fetched.
+    :param bool reconcile: True if a previous post of the offense may have reached SOAR (interrupted post recovered from the outbox, or started by the previous owner of the domain). SOAR is checked before posting it again.
+    :return: None
+    :rtype: None"""
+    offense_id = offense.get('id', None)
+    domain_id = str(offense.get('domain_id'))
+    if not in_flight_posts.start(domain_id):
+        offenses_to_ibm_soar_logger.debug(f"Dropping offense {offense_id}. Its domain is being released to another instance.")
+        return
+    try:
+        #Checked once the post is registered: a release either waits for this post or has already reset the checkpoint
+        if not checkpoint_tracker.is_current(key, generation):
+            offenses_to_ibm_soar_logger.debug(f"Dropping offense {offense_id}. It was fetched before its checkpoint was reset.")
+            return
+        if lease_coordination.coordinator is not None and not lease_coordination.coordinator.owns(domain_id):
+            offenses_to_ibm_soar_logger.warning(f"Lease of domain {domain_id} lost before escalating offense {offense_id}. Leaving it to the new owner of the domain.")
+            forget_checkpoints([key])
+            return
+        escalate_offense(offense, key, generation, reconcile)
+    finally:
+        in_flight_posts.finish(domain_id)
+
+def escalate_offense(offense:Dict[any,any], key:str, generation:int, reconcile:bool) -> None:
+    """Posts an offense to SOAR (or stores its failure), records the outcome on the outbox and moves its checkpoint. See process_offense()."""
+    offense_id = offense.get('id', None)
+    offenses_to_ibm_soar_logger.info(f"Processing offense with ID. About to create it on SOAR!: {offense_id}")
+    try:
+        if reconcile and find_offense_in_soar(offense) is not None:
+            offenses_to_ibm_soar_logger.info(f"Offense with ID {offense_id} was already created on SOAR (before a restart or by the previous owner of its domain). Not posting it again.")
+        else:
+            escalation_outbox.record_sending(offense, key)
+            if lease_coordination.coordinator is not None:
+                lease_coordination.coordinator.record_post(str(offense.get('domain_id')), offense_id)
+            create_offense_in_soar(offense)
+        outcome = "sent"
+    except ReconciliationError as e:
+        #Nothing was posted: the offense is retried by the failed offenses thread and never dead-lettered for a failed lookup
+        offenses_to_ibm_soar_logger.warning(str(e))
+        save_failed_offense_creation_on_soar(offense_id)
+        outcome = "failed"
+    except Exception as e:
+        offenses_to_ibm_soar_logger.error(f"Exception creating SOAR incident for offense with ID: {str(offense_id)}: {str(e)}")
+        save_failed_offense(offense_id, e, offenses_to_ibm_soar_logger) #store the failed offense to be retried (or dead-lettered)
+        outcome = "failed"
+    #The offense is escalated or its failure stored, so the checkpoint can move past it
+    escalation_outbox.record_outcome(offense_id, outcome)
+    checkpoint_tracker.complete(key, offense_id, generation)
+
+def soar_post_worker() -> None:
+    """Post worker thread. Takes the offenses from the scheduler (fair between SOAR organizations) and escalates them."""
+    while True:
+        org, (offense, key, generation, reconcile) = offenses_scheduler.next()
+        try:
+            with profiled_iteration():
+                process_offense(offense, key, generation, reconcile)
+        except Exception as e:
+            offenses_to_ibm_soar_logger.critical(f"Error escalating offense {offense.get('id')} to IBM SOAR organization {org}. Its checkpoint will not move past it until the app is restarted: {str(e)}")
+        finally:
+            offenses_scheduler.task_done(org)
 
 def init_vars(passedconfig: ServerConfig):
     '''
@@ -247,19 +676,118 @@ def init_vars(passedconfig: ServerConfig):
     config = passedconfig
     global qradar_headers
     qradar_headers = {'SEC': config.qradar_api_key, 'Accept': 'application/json'}
+    #requests asks for compressed responses by default, so the header is always set (identity disables the compression)
+    qradar_headers["Accept-Encoding"] = "gzip" if config.qradar_gzip_responses else "identity"
+    global qradar_query_executor
+    qradar_query_executor = ThreadPoolExecutor(max_workers=config.qradar_domain_filter_max_workers, thread_name_prefix="qradar_query")
+    global offenses_scheduler
+    offenses_scheduler = FairOffenseScheduler(config.soar_org_weights, config.soar_org_concurrency_limits, default_concurrency=config.per_org_concurrency)
+    coordinator = lease_coordination.coordinator
+    if coordinator is not None:
+        coordinator.add_release_listener(release_domains)
+
+def init_escalation_outbox(server_config: ServerConfig) -> EscalationOutbox:
+    '''Creates the escalation outbox of this instance and locks it for this process. With coordination every instance has its own outbox
+    (the instance ID is appended to the file name). Must be called after init_coordination and before main.
+
+    :param ServerConfig server_config: Configuration of the app.
+    :return: The escalation outbox.
+    :rtype: EscalationOutbox
+    :raises RuntimeError: if another process is using the same outbox
+    '''
+    global escalation_outbox
+    coordinator = lease_coordination.coordinator
+    outbox = EscalationOutbox(server_config.escalation_outbox_file if coordinator is None else f"{server_config.escalation_outbox_file}.{coordinator.instance_id}")
+    outbox.lock_exclusively()
+    escalation_outbox = outbox
+    return escalation_outbox
+
+def recover_from_outbox() -> int:
+    """Resumes the escalations recorded on the outbox before a restart, in a single pass over it: queued offenses are queued again with their
+    stored payload (no QRADAR query), interrupted posts are queued to be checked on SOAR before posting them again, and the checkpoints move past
+    the offenses already escalated. Entries of domains not leased by this instance are dropped: their new owner fetches them from the stored checkpoint
+    and checks the posts started here on SOAR (lease store posts).
+
+    :return: Number of offenses queued again.
+    :rtype: int
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/reading the files"""
+    entries = escalation_outbox.load()
+    get_domains_available()
+    domain_checkpoints = load_domain_checkpoints()
+    persisted_checkpoints = {checkpoint_key(domain): checkpoint for domain, checkpoint in domain_checkpoints.items()}
+    for domain, checkpoint in domain_checkpoints.items():
+        checkpoint_tracker.fetch_checkpoint(checkpoint_key(domain), domain, checkpoint)
+        escalation_outbox.checkpoint_saved(checkpoint_key(domain), checkpoint)
+
+    escalation_outbox.forget({entry.get("key") for entry in entries.values()} - set(persisted_checkpoints))
+    resumed, escalated = [], []
+    for offense_id, entry in sorted(entries.items()):
+        key = entry.get("key")
+        #Offenses covered by the checkpoint are done
+        if key not in persisted_checkpoints:
+            continue
+        if offense_id <= persisted_checkpoints[key]:
+            if entry.get("state") != DONE:
+                #Escalated by another instance while its domain was leased by it
+                escalation_outbox.record_outcome(offense_id, "checkpointed")
+            continue
+        generation = checkpoint_tracker.track(key, offense_id)
+        if entry.get("state") == DONE:
+            escalated.append((key, offense_id, generation))
+        else:
+            resumed.append((entry, generation))
+    #Offenses of a domain are fetched in ID order, so every offense of the domain up to its last entry was fetched (and is on the outbox or checkpointed)
+    for offense_id, entry in entries.items():
+        if entry.get("key") in persisted_checkpoints and offense_id > persisted_checkpoints[entry.get("key")]:
+            checkpoint_tracker.advance(entry.get("key"), str(entry.get("domain_id")), offense_id)
+    for key, offense_id, generation in escalated:
+        checkpoint_tracker.complete(key, offense_id, generation)
+    for entry, generation in resumed:
+        offense = entry["offense"]
+        offenses_scheduler.submit(get_soar_org_of_offense(offense), (offense, entry.get("key"), generation, entry.get("state") == SENDING))
+    escalation_outbox.compact()
+    offenses_to_ibm_soar_logger.info(f"Escalation outbox recovered: {len(resumed)} offenses queued again ({sum(1 for entry, _ in resumed if entry.get('state') == SENDING)} interrupted posts to check on SOAR), {len(escalated)} offenses already escalated.")
+    return len(resumed)
 
 def main(passedconfig: ServerConfig):
     
     init_vars(passedconfig)
 
-    """Main loop to continuously check for new offenses and process them."""
+    """Main loop to continuously check for new offenses and process them. Wakes up on every poll or, if the notification listener is enabled,
+    as soon as an offense notification arrives (polling keeps running at the slower safety net rate)."""
+    if escalation_outbox is None:
+        init_escalation_outbox(config)
+    try:
+        recover_from_outbox()
+    except Exception as e:
+        offenses_to_ibm_soar_logger.error(f"Error recovering the escalations from the outbox. Offenses are fetched again from the last checkpoint: {str(e)}")
+
+    for worker_number in range(config.soar_post_workers):
+        threading.Thread(target=soar_post_worker, name=f"soar_post_worker_{worker_number}", daemon=True).start()
+
+    notified_domains = None
     while True:
-        try:
-            get_domains_available()
-            process_offense()
-        except Exception as e:
-            offenses_to_ibm_soar_logger.error(f"Error pulling and/or sending offenses to IBM SOAR from QRADAR SIEM Offenses obtention: {str(e)}")
-        time.sleep(config.polling_rate_new_offenses_checking)
+        for _ in range(MAX_FETCHES_PER_WAKE_UP):
+            with lease_coordination.partitions_work_lock():
+                try:
+                    with profiled_iteration():
+                        get_domains_available()
+                        queued = fetch_and_schedule_offenses(notified_domains)
+                except Exception as e:
+                    offenses_to_ibm_soar_logger.error(f"Error pulling and/or sending offenses to IBM SOAR from QRADAR SIEM Offenses obtention: {str(e)}")
+                    queued = 0
+            #Keep fetching while full batches are obtained (a backlog is queued at once, so the scheduler can serve every customer fairly)
+            #or, after a notification, until the notified domains have nothing new.
+            if not (queued >= config.offenses_fetch_batch_size or (queued and notified_domains)):
+                break
+
+        notification_queue = offense_notification_listener.notification_queue
+        if notification_queue is None:
+            time.sleep(config.polling_rate_new_offenses_checking)
+        else:
+            notified_domains = notification_queue.wait(config.notifications_safety_polling_rate)
+            if notified_domains:
+                offenses_to_ibm_soar_logger.info(f"Offense notifications received for domains {sorted(notified_domains)}. Getting offenses from QRADAR SIEM...")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,57 @@
+'''Operator command for the dead-letter store. Lists the dead-lettered offenses or requeues them on the failed offenses file
+(after fixing the configuration/SOAR problem), so the failed offenses thread retries them on its next sweep.
+
+Usage (from the folder with the config.ini file):
+    python app/requeue_dead_letter_offenses.py --list
+    python app/requeue_dead_letter_offenses.py 1234 1235
+    python app/requeue_dead_letter_offenses.py --all'''
+import argparse
+from app_config import server_config, failed_offenses_to_ibm_soar_retries_logger
+from dead_letter_store import load_dead_letter_offenses, remove_dead_letter_offenses
+import qradar_siem_offenses_to_soar
+
+def list_dead_letter_offenses() -> None:
+    '''Prints the dead-lettered offenses with their errors.'''
+    entries = load_dead_letter_offenses(server_config.dead_letter_offenses_file)
+    if not entries:
+        print("The dead-letter store is empty.")
+    for offense_id, entry in entries.items():
+        print(f"{offense_id}: [{entry.get('error_type')} {entry.get('status_code') or ''}] {entry.get('error')} (by {entry.get('source')})")
+
+def requeue_dead_letter_offenses(offense_ids:set[int] = None) -> None:
+    '''Moves dead-lettered offenses back to the failed offenses file.
+
+    :param set[int] offense_ids: IDs of the offenses to requeue. If None, every dead-lettered offense is requeued.
+    '''
+    entries = load_dead_letter_offenses(server_config.dead_letter_offenses_file)
+    #Added to the failed offenses file before removing them from the store, so a crash in between never loses an offense
+    for offense_id in entries:
+        if offense_ids is None or offense_id in offense_ids:
+            qradar_siem_offenses_to_soar.save_failed_offense_creation_on_soar(offense_id)
+    removed = remove_dead_letter_offenses(server_config.dead_letter_offenses_file, {offense_id for offense_id in entries if offense_ids is None or offense_id in offense_ids})
+    for entry in removed:
+        failed_offenses_to_ibm_soar_retries_logger.warning(f"Offense with ID {entry['offense_id']} requeued from the dead-letter store to the failed offenses file.")
+    if offense_ids is not None:
+        for offense_id in offense_ids - {entry["offense_id"] for entry in removed}:
+            print(f"Offense {offense_id} is not on the dead-letter store.")
+    print(f"Requeued {len(removed)} offenses. They will be retried on the next failed offenses sweep.")
+
+def main():
+    parser = argparse.ArgumentParser(description="List or requeue offenses from the dead-letter store.")
+    parser.add_argument("offense_ids", nargs="*", type=int, help="IDs of the offenses to requeue")
+    parser.add_argument("--all", action="store_true", help="requeue every dead-lettered offense")
+    parser.add_argument("--list", action="store_true", help="list the dead-lettered offenses")
+    args = parser.parse_args()
+
+    qradar_siem_offenses_to_soar.init_vars(server_config)
+    if args.list:
+        list_dead_letter_offenses()
+    elif args.all:
+        requeue_dead_letter_offenses()
+    elif args.offense_ids:
+        requeue_dead_letter_offenses(set(args.offense_ids))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 import requests
+import logging
 import time
 import os
-import json
 from typing import Dict
+import json_codec
 from app_config import ServerConfig, failed_offenses_to_ibm_soar_retries_logger
-from qradar_siem_offenses_to_soar import create_offense_in_soar
+from qradar_siem_offenses_to_soar import create_offense_in_soar, failed_offenses_file_guard, find_offense_in_soar
+from durable_files import write_file_atomically
+import lease_coordination
+from dead_letter_store import add_dead_letter_offense, get_dead_letter_offense_ids
+from escalation_errors import ReconciliationError, describe_failure, is_permanent_failure
+from profiling_hooks import profiled_iteration
 
 qradar_headers = {'SEC': None, 'Accept': 'application/json'} #Headers for QRadar API. Paritally obtained from config.ini file
 failed_offenses_ids_list = [] #do not edit! Used to temporary store in memory the failed offenses IDs obtained from the file
@@ -25,7 +31,8 @@ def load_failed_ids_from_file() -> str:
 
 
 def remove_offense_id_from_failed_offenses_file(offense_id:int) -> None:
-    """Remove the offense Id from the failed offense file and from memory and rewrites the file with the failed missing offenses (if any)
+    """Remove the offense Id from the failed offense file and from memory and rewrites the file with the failed missing offenses (if any).
+    The file is read again before rewriting it, so IDs appended by the offenses thread in the meantime are kept.
     
     :param int offense_id: The ID of the offense to remove from the file and memory.
     :return: Nothing
@@ -37,20 +44,29 @@ def remove_offense_id_from_failed_offenses_file(offense_id:int) -> None:
     try:
         failed_offenses_ids_list.remove(offense_id)
     except:
-        failed_offenses_to_ibm_soar_retries_logger.warn("Error removing failed offense ID from file. The offense ID did not exist on the file. Was the file manipulated by a user?.")
-    
-    failed_offenses_ids_as_string = [str(id) for id in failed_offenses_ids_list]
-    comma_separated_string_of_failed_offense_ids = ",".join(failed_offenses_ids_as_string)
+        failed_offenses_to_ibm_soar_retries_logger.warning("Error removing failed offense ID from memory. The offense ID did not exist on the file. Was the file manipulated by a user?.")
+
+    with failed_offenses_file_guard():
+        ids = load_failed_ids_from_file() or ''
+        remaining_ids = [id_str.strip() for id_str in ids.split(",") if id_str.strip() != "" and safe_convert_offense_id(id_str) != offense_id]
+        comma_separated_string_of_failed_offense_ids = ",".join(remaining_ids)
 
-    with open(config.failed_processed_id_file, 'w') as file:
-        if comma_separated_string_of_failed_offense_ids:
-            file.write(comma_separated_string_of_failed_offense_ids)
-        else:
-            file.write("")
+        write_file_atomically(config.failed_escalations_offenses_file, comma_separated_string_of_failed_offense_ids)
 
     failed_offenses_to_ibm_soar_retries_logger.info(f"Deleted succcesfully offense ID from the failed offenses file with ID {str(offense_id)}")
 
+def move_offense_to_dead_letter_store(offense_id:int, error:Exception) -> None:
+    """Stores a permanently failed offense on the dead-letter store and removes it from the failed offenses file, so it is not retried anymore.
 
+    :param int offense_id: The ID of the offense that failed permanently.
+    :param Exception error: The exception raised when escalating the offense.
+    :return: Nothing
+    :rtype: None
+    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/editing the files
+    """
+    failed_offenses_to_ibm_soar_retries_logger.error(f"Offense with ID {str(offense_id)} failed permanently. Moving it to the dead-letter store. It will not be retried until it is requeued.")
+    add_dead_letter_offense(config.dead_letter_offenses_file, offense_id, describe_failure(error), failed_offenses_to_ibm_soar_retries_logger.name)
+    remove_offense_id_from_failed_offenses_file(offense_id)
 
 def get_offense(offense_id: int)-> Dict[any,any]: 
     """Retrieve an offense from QRADAR.
@@ -65,7 +81,7 @@ def get_offense(offense_id: int)-> Dict[any,any]:
     qradar_headers["VERSION"] = "20.0"
     response = requests.get(config.qradar_url + "/" + str(offense_id), headers=qradar_headers, verify=False)
     response.raise_for_status()
-    return response.json()
+    return json_codec.decode_response(response)
 
 
 
@@ -77,19 +93,35 @@ def process_offense(offense_id: int) -> None:
     :rtype: None
     """
     failed_offenses_to_ibm_soar_retries_logger.info("Processing and sending to IBM SOAR the old failed-to-upload offense_id to IBM SOAR with ID: " + str(offense_id))
-    latest_offense = get_offense(offense_id)
-    failed_offenses_to_ibm_soar_retries_logger.debug("Offense obtained from QRADAR SIEM: " + json.dumps(latest_offense))
+    try:
+        latest_offense = get_offense(offense_id)
+    except Exception as e:
+        if is_permanent_failure(e):
+            move_offense_to_dead_letter_store(offense_id, e)
+            return
+        raise
+    if failed_offenses_to_ibm_soar_retries_logger.isEnabledFor(logging.DEBUG):
+        failed_offenses_to_ibm_soar_retries_logger.debug("Offense obtained from QRADAR SIEM: " + json_codec.dumps_str(latest_offense))
 
     if latest_offense and latest_offense.get("status", None) == "OPEN":
         offense_id = latest_offense.get('id',None)
         failed_offenses_to_ibm_soar_retries_logger.info(f"Processing offense with ID. About to create case on IBM SOAR!: {str(offense_id)}")
         try:
-            create_offense_in_soar(latest_offense)
+            #A previous attempt may have reached SOAR (timeout after the case was created, or crash before removing the ID from the file)
+            if find_offense_in_soar(latest_offense) is not None:
+                failed_offenses_to_ibm_soar_retries_logger.info(f"IBM SOAR case already exists for offense with ID: {str(offense_id)} . Not creating it again.")
+            else:
+                create_offense_in_soar(latest_offense)
             failed_offenses_to_ibm_soar_retries_logger.info(f"IBM SOAR case created succesfully for offense with ID: " + str(offense_id) + " . Proceeding to delete the ID of the offense from the failed offenses file.")
             remove_offense_id_from_failed_offenses_file(offense_id)
             pass
+        except ReconciliationError as e:
+            #Nothing was posted. The offense stays on the failed offenses file (never dead-lettered for a failed lookup)
+            failed_offenses_to_ibm_soar_retries_logger.warning(str(e))
         except Exception as e:
             failed_offenses_to_ibm_soar_retries_logger.error(f"Error creating SOAR case on IBM SOAR for offense with id {offense_id} . Error: {str(e)}" )
+            if is_permanent_failure(e):
+                move_offense_to_dead_letter_store(offense_id, e)
     else:
         failed_offenses_to_ibm_soar_retries_logger.warning(f"Offense {offense_id} is closed or non-existent in QRADAR. Removing the offense ID from the file.")
         remove_offense_id_from_failed_offenses_file(offense_id)
@@ -108,6 +140,8 @@ def init_vars(passedconfig: ServerConfig):
     config = passedconfig
     global qradar_headers
     qradar_headers = {'SEC': config.qradar_api_key, 'Accept': 'application/json'}
+    #requests asks for compressed responses by default, so the header is always set (identity disables the compression)
+    qradar_headers["Accept-Encoding"] = "gzip" if config.qradar_gzip_responses else "identity"
 
 
 def safe_convert_offense_id(id_str):
@@ -124,36 +158,45 @@ def main(passedconfig: ServerConfig):
 
     """Main loop to continuously check for failed offenses and try reuploading them to IBM SOAR."""
     while True:
+        coordinator = lease_coordination.coordinator
+        if coordinator is not None and not coordinator.owns(lease_coordination.FAILED_OFFENSES_SWEEP_PARTITION):
+            failed_offenses_to_ibm_soar_retries_logger.debug(f"Instance {coordinator.instance_id} does not hold the failed offenses sweep lease. Another instance is retrying the failed offenses.")
+            time.sleep(config.polling_rate_offenses_failure_reuploading)
+            continue
+        try:
+            with profiled_iteration():
+                ids = load_failed_ids_from_file()
 
-        ids = load_failed_ids_from_file()
-
-        if ids == None:
-            ids = ''
+                if ids == None:
+                    ids = ''
 
-        ids_as_string = ids.split(",")
+                ids_as_string = ids.split(",")
 
-        missing_failed_offenses_mssg = "No failed offense IDs to upload to IBM SOAR were found on the Failed IBM SOAR Offense Uploads File."
-        if (ids_as_string and len(ids_as_string) > 0):
-            global failed_offenses_ids_list
+                missing_failed_offenses_mssg = "No failed offense IDs to upload to IBM SOAR were found on the Failed IBM SOAR Offense Uploads File."
+                if (ids_as_string and len(ids_as_string) > 0):
+                    global failed_offenses_ids_list
 
-            # Use a set to avoid duplicates
-            failed_offenses_ids_set = {
-                safe_convert_offense_id(id_str) for id_str in ids_as_string if id_str.strip() != ""
-            }
+                    # Use a set to avoid duplicates
+                    failed_offenses_ids_set = {
+                        safe_convert_offense_id(id_str) for id_str in ids_as_string if id_str.strip() != ""
+                    }
 
-            # Filter out None values and convert back to a list
-            failed_offenses_ids_list = [id for id in failed_offenses_ids_set if id is not None]
+                    # Filter out None values and dead-lettered offenses (they will fail again until they are requeued) and convert back to a list
+                    dead_letter_ids = get_dead_letter_offense_ids(config.dead_letter_offenses_file)
+                    failed_offenses_ids_list = [id for id in failed_offenses_ids_set if id is not None and id not in dead_letter_ids]
     
-            if (len(failed_offenses_ids_list) > 0):
-                for id in failed_offenses_ids_list:
-                    try:
-                        process_offense(id)
-                    except Exception as e:
-                        failed_offenses_to_ibm_soar_retries_logger.error(f"Error pulling and/or sending previously failed offense to IBM SOAR with ID: {e}. Advancing to next offense.")
-            else:
-                failed_offenses_to_ibm_soar_retries_logger.error(missing_failed_offenses_mssg)
-        else:
-            failed_offenses_to_ibm_soar_retries_logger.error(missing_failed_offenses_mssg)
+                    if (len(failed_offenses_ids_list) > 0):
+                        for id in failed_offenses_ids_list:
+                            try:
+                                process_offense(id)
+                            except Exception as e:
+                                failed_offenses_to_ibm_soar_retries_logger.error(f"Error pulling and/or sending previously failed offense to IBM SOAR with ID: {e}. Advancing to next offense.")
+                    else:
+                        failed_offenses_to_ibm_soar_retries_logger.error(missing_failed_offenses_mssg)
+                else:
+                    failed_offenses_to_ibm_soar_retries_logger.error(missing_failed_offenses_mssg)
+        except Exception as e:
+            failed_offenses_to_ibm_soar_retries_logger.error(f"Error retrying the failed offenses. Retrying them on the next sweep: {str(e)}")
         time.sleep(config.polling_rate_offenses_failure_reuploading)
 
 
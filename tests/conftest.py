@@ -0,0 +1,36 @@
+'''Test setup. The app modules are flat modules of the app folder and app_config reads config.ini (and opens the log files on the logs
+folder) from the working directory when imported, so it is imported from a temporary folder with a minimal config.'''
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+TEST_CONFIG = """
+[MainConfig]
+qradar_url = http://qradar.test/api/siem/offenses
+soar_url = http://soar.test/rest/orgs
+qradar_api_key = test
+failed_escalations_offenses_file = failed_soar_offense_creations.txt
+last_escalated_offense_file = last_escalated_offense_offset_id.txt
+
+[Logging]
+logging_level = warning
+cli_logging_enabled = false
+
+[OffensesPollingRate]
+polling_rate_new_offenses_checking = 1
+polling_rate_offenses_failure_reuploading = 1
+"""
+
+_test_dir = tempfile.mkdtemp(prefix="qradar2soar_tests_")
+os.makedirs(os.path.join(_test_dir, "logs"))
+with open(os.path.join(_test_dir, "config.ini"), "w") as file:
+    file.write(TEST_CONFIG)
+_cwd = os.getcwd()
+os.chdir(_test_dir)
+try:
+    import app_config  # noqa: F401
+finally:
+    os.chdir(_cwd)
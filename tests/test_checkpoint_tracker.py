@@ -0,0 +1,77 @@
+import pytest
+import qradar_siem_offenses_to_soar
+from qradar_siem_offenses_to_soar import CheckpointTracker
+
+@pytest.fixture
+def saved(monkeypatch):
+    '''Records the checkpoints saved by the tracker instead of writing them.'''
+    saved = []
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "save_checkpoint", lambda key, offense_id: saved.append((key, offense_id)))
+    return saved
+
+def fetch(tracker, key, domain_id, offense_ids, persisted_checkpoint=100):
+    tracker.fetch_checkpoint(key, domain_id, persisted_checkpoint)
+    generations = {offense_id: tracker.track(key, offense_id) for offense_id in offense_ids}
+    tracker.advance(key, domain_id, max(offense_ids))
+    return generations
+
+def test_checkpoint_waits_for_gaps_when_posts_finish_out_of_order(saved):
+    tracker = CheckpointTracker()
+    generations = fetch(tracker, "1", "1", [101, 102, 103])
+
+    tracker.complete("1", 103, generations[103])
+    assert saved == []
+    tracker.complete("1", 101, generations[101])
+    assert saved == [("1", 101)]
+    tracker.complete("1", 102, generations[102])
+    assert saved == [("1", 101), ("1", 103)]
+
+def test_checkpoint_does_not_pass_the_cursor_of_a_lagging_domain(saved):
+    tracker = CheckpointTracker()
+    #Both domains share the single checkpoint (no coordination). Domain 2 was left out of the fetch, its cursor is still 100
+    tracker.fetch_checkpoint(None, "2", 100)
+    generations = fetch(tracker, None, "1", [101, 105])
+
+    tracker.complete(None, 101, generations[101])
+    tracker.complete(None, 105, generations[105])
+    assert saved == []
+
+    tracker.advance(None, "2", 104)
+    generation = tracker.track(None, 107)
+    tracker.advance(None, "1", 107)
+    tracker.complete(None, 107, generation)
+    assert saved == [(None, 104)]
+
+def test_completions_from_before_a_reset_are_ignored(saved):
+    tracker = CheckpointTracker()
+    generations = fetch(tracker, "1", "1", [101, 102])
+
+    tracker.reset("1")
+    assert not tracker.is_current("1", generations[101])
+    tracker.complete("1", 101, generations[101])
+    tracker.complete("1", 102, generations[102])
+    assert saved == []
+    assert tracker.keys() == []
+
+    #The new fetch starts again from the persisted checkpoint
+    generations = fetch(tracker, "1", "1", [101, 102])
+    assert tracker.is_current("1", generations[101])
+    tracker.complete("1", 101, generations[101])
+    tracker.complete("1", 102, generations[102])
+    assert saved == [("1", 101), ("1", 102)]
+
+def test_checkpoint_is_never_saved_below_the_persisted_one(saved):
+    tracker = CheckpointTracker()
+    #Offense recovered from the outbox, tracked before the persisted checkpoint is known
+    generation = tracker.track("1", 95)
+    assert tracker.fetch_checkpoint("1", "1", 100) == 100
+    tracker.complete("1", 95, generation)
+    assert saved == []
+
+    #A lower persisted checkpoint read later does not move the cursor back
+    tracker.advance("1", "1", 110)
+    assert tracker.fetch_checkpoint("1", "1", 90) == 110
+    generation = tracker.track("1", 111)
+    tracker.advance("1", "1", 111)
+    tracker.complete("1", 111, generation)
+    assert saved == [("1", 111)]
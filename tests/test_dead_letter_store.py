@@ -0,0 +1,64 @@
+import pytest
+import app_config
+import qradar_siem_offenses_to_soar
+import requeue_dead_letter_offenses
+from dead_letter_store import add_dead_letter_offense, get_dead_letter_offense_ids, load_dead_letter_offenses, remove_dead_letter_offenses
+
+FAILURE = {"classification": "permanent", "error": "422 Client Error"}
+
+def test_append_after_a_torn_line_keeps_every_entry(tmp_path):
+    file_path = str(tmp_path / "dead_letter.jsonl")
+    add_dead_letter_offense(file_path, 101, FAILURE, "offenses")
+    #Crash in the middle of an append
+    with open(file_path, 'ab') as file:
+        file.write(b'{"offense_id": 102, "sour')
+    add_dead_letter_offense(file_path, 103, FAILURE, "retries")
+
+    entries = load_dead_letter_offenses(file_path)
+    assert sorted(entries) == [101, 103]
+    assert entries[103]["source"] == "retries" and entries[103]["error"] == "422 Client Error"
+
+def test_remove_rewrites_the_file_without_the_removed_offenses(tmp_path):
+    file_path = str(tmp_path / "dead_letter.jsonl")
+    for offense_id in (101, 102, 103):
+        add_dead_letter_offense(file_path, offense_id, FAILURE, "offenses")
+
+    removed = remove_dead_letter_offenses(file_path, {102, 104})
+    assert [entry["offense_id"] for entry in removed] == [102]
+    assert get_dead_letter_offense_ids(file_path) == {101, 103}
+
+    assert len(remove_dead_letter_offenses(file_path)) == 2
+    assert get_dead_letter_offense_ids(file_path) == set()
+    assert get_dead_letter_offense_ids(str(tmp_path / "missing.jsonl")) == set()
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_config.server_config, "dead_letter_offenses_file", str(tmp_path / "dead_letter.jsonl"))
+    monkeypatch.setattr(app_config.server_config, "failed_escalations_offenses_file", str(tmp_path / "failed.txt"))
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "config", app_config.server_config)
+    return app_config.server_config
+
+def test_requeue_moves_offenses_to_the_failed_offenses_file(files):
+    for offense_id in (101, 102, 103):
+        add_dead_letter_offense(files.dead_letter_offenses_file, offense_id, FAILURE, "offenses")
+
+    requeue_dead_letter_offenses.requeue_dead_letter_offenses({101, 103})
+
+    assert qradar_siem_offenses_to_soar.load_failed_offense_ids() == ["101", "103"]
+    assert get_dead_letter_offense_ids(files.dead_letter_offenses_file) == {102}
+
+def test_requeue_saves_on_the_failed_offenses_file_before_removing(files, monkeypatch):
+    add_dead_letter_offense(files.dead_letter_offenses_file, 101, FAILURE, "offenses")
+    still_dead_lettered = []
+
+    def failing_save(offense_id):
+        still_dead_lettered.append(offense_id in get_dead_letter_offense_ids(files.dead_letter_offenses_file))
+        raise OSError("disk full")
+
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "save_failed_offense_creation_on_soar", failing_save)
+    with pytest.raises(OSError):
+        requeue_dead_letter_offenses.requeue_dead_letter_offenses()
+
+    #The failed save never loses the offense: it is still on the dead-letter store
+    assert still_dead_lettered == [True]
+    assert get_dead_letter_offense_ids(files.dead_letter_offenses_file) == {101}
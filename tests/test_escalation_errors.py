@@ -0,0 +1,57 @@
+import types
+import pytest
+import requests
+import qradar_siem_offenses_to_soar
+from escalation_errors import PermanentEscalationError, ReconciliationError, describe_failure, is_permanent_failure
+
+def http_error(status_code, text="error"):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode("utf-8")
+    return requests.exceptions.HTTPError(f"{status_code} error", response=response)
+
+@pytest.mark.parametrize("status_code", [400, 401, 403, 404, 422])
+def test_rejected_requests_are_permanent(status_code):
+    assert is_permanent_failure(http_error(status_code))
+
+@pytest.mark.parametrize("status_code", [408, 429, 500, 502, 503])
+def test_server_and_throttling_errors_are_transient(status_code):
+    assert not is_permanent_failure(http_error(status_code))
+
+@pytest.mark.parametrize("error", [requests.exceptions.ConnectionError("refused"), requests.exceptions.Timeout("timeout"), OSError("disk")])
+def test_errors_without_response_are_transient(error):
+    assert not is_permanent_failure(error)
+
+@pytest.mark.parametrize("url", ["", "soar.example.com/rest/orgs", "http://"])
+def test_malformed_urls_are_permanent(url):
+    with pytest.raises(requests.exceptions.RequestException) as raised:
+        requests.Request("POST", url).prepare()
+    assert is_permanent_failure(raised.value)
+
+def test_escalation_errors_are_permanent():
+    assert is_permanent_failure(PermanentEscalationError("No domain ID assigned to the offense"))
+
+def test_failure_description_keeps_the_truncated_response():
+    failure = describe_failure(http_error(422, "x" * 5000))
+    assert failure["classification"] == "permanent"
+    assert failure["status_code"] == 422
+    assert failure["error_type"] == "HTTPError"
+    assert len(failure["response"]) == 2000
+
+def test_offenses_that_can_not_be_built_into_an_incident_are_permanent(monkeypatch):
+    config = types.SimpleNamespace(customer_configurations_by_domain={"1": {"soar_org_id": "201", "soar_api_key_auth": "key"}})
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "config", config)
+    with pytest.raises(PermanentEscalationError) as raised:
+        qradar_siem_offenses_to_soar.create_offense_in_soar({"id": 101, "domain_id": 1, "description": None})
+    assert is_permanent_failure(raised.value)
+
+def test_failed_lookups_on_soar_are_transient(monkeypatch):
+    config = types.SimpleNamespace(customer_configurations_by_domain={"1": {"soar_org_id": "201", "soar_api_key_auth": "key"}})
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "config", config)
+    def forbidden(soar_mapping, path, payload):
+        raise http_error(403)
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "post_to_soar", forbidden)
+
+    with pytest.raises(ReconciliationError) as raised:
+        qradar_siem_offenses_to_soar.find_offense_in_soar({"id": 101, "domain_id": 1})
+    assert not is_permanent_failure(raised.value)
@@ -0,0 +1,69 @@
+import pytest
+from escalation_outbox import DONE, QUEUED, SENDING, EscalationOutbox
+
+def offense(offense_id, domain_id=1):
+    return {"id": offense_id, "domain_id": domain_id, "status": "OPEN", "description": f"offense {offense_id}"}
+
+def test_replay_keeps_the_last_state_of_every_offense(tmp_path):
+    outbox = EscalationOutbox(str(tmp_path / "outbox.jsonl"))
+    outbox.record_queued([(offense(101), "1"), (offense(102), "1"), (offense(103), "1")])
+    outbox.record_sending(offense(101), "1")
+    outbox.record_outcome(101, "sent")
+    outbox.record_sending(offense(102), "1")
+
+    entries = EscalationOutbox(outbox.file_path).load()
+    assert {offense_id: entry["state"] for offense_id, entry in entries.items()} == {101: DONE, 102: SENDING, 103: QUEUED}
+    assert entries[101]["outcome"] == "sent" and "offense" not in entries[101]
+    assert entries[102]["offense"] == offense(102) and entries[102]["key"] == "1"
+
+def test_replay_ignores_a_torn_last_line(tmp_path):
+    outbox = EscalationOutbox(str(tmp_path / "outbox.jsonl"))
+    outbox.record_queued([(offense(101), "1"), (offense(102), "1")])
+    #Crash in the middle of the append of the outcome of 101
+    with open(outbox.file_path, 'ab') as file:
+        file.write(b'{"offense_id": 101, "state": "do')
+
+    recovered = EscalationOutbox(outbox.file_path)
+    entries = recovered.load()
+    assert {offense_id: entry["state"] for offense_id, entry in entries.items()} == {101: QUEUED, 102: QUEUED}
+
+    #The next record starts on its own line, so it is not lost with the torn one
+    recovered.record_outcome(101, "sent")
+    entries = EscalationOutbox(outbox.file_path).load()
+    assert entries[101]["state"] == DONE
+    assert entries[102]["state"] == QUEUED
+
+def test_compaction_drops_only_done_entries_covered_by_their_checkpoint(tmp_path):
+    outbox = EscalationOutbox(str(tmp_path / "outbox.jsonl"))
+    outbox.record_queued([(offense(offense_id), "1") for offense_id in (101, 102, 103, 104)] + [(offense(101 + 100, 2), "2")])
+    for offense_id in (101, 102, 104, 201):
+        outbox.record_outcome(offense_id, "sent")
+    outbox.checkpoint_saved("1", 102)
+    outbox.checkpoint_saved("1", 101) #Older checkpoints never move it back
+
+    outbox.compact()
+
+    entries = EscalationOutbox(outbox.file_path).load()
+    #103 is still queued, 104 is above the checkpoint and 201 has no checkpoint saved
+    assert sorted(entries) == [103, 104, 201]
+    assert entries[103]["offense"] == offense(103)
+    with open(outbox.file_path, 'rb') as file:
+        assert len(file.readlines()) == 3
+
+def test_forgotten_checkpoints_drop_every_entry(tmp_path):
+    outbox = EscalationOutbox(str(tmp_path / "outbox.jsonl"))
+    outbox.record_queued([(offense(101), "1"), (offense(102), "1"), (offense(201, 2), "2")])
+    outbox.record_sending(offense(102), "1")
+    outbox.record_outcome(101, "sent")
+
+    outbox.forget(["1", "3"])
+
+    assert outbox.get(101) is None and outbox.get(102) is None
+    assert sorted(EscalationOutbox(outbox.file_path).load()) == [201]
+
+def test_outbox_is_locked_for_a_single_process(tmp_path):
+    outbox = EscalationOutbox(str(tmp_path / "outbox.jsonl"))
+    outbox.lock_exclusively()
+    with pytest.raises(RuntimeError):
+        EscalationOutbox(outbox.file_path).lock_exclusively()
+    EscalationOutbox(str(tmp_path / "other_outbox.jsonl")).lock_exclusively()
@@ -0,0 +1,104 @@
+import threading
+import time
+from fair_offense_scheduler import FairOffenseScheduler
+
+def drain(scheduler):
+    picked = []
+    while True:
+        next_item = scheduler.next(timeout=0)
+        if next_item is None:
+            return picked
+        org, item = next_item
+        picked.append(item)
+        scheduler.task_done(org)
+
+def test_deficit_round_robin_follows_the_weights():
+    scheduler = FairOffenseScheduler(weights={"a": 2}, default_concurrency=10)
+    for item in ["a1", "a2", "a3", "a4"]:
+        scheduler.submit("a", item)
+    for item in ["b1", "b2", "b3"]:
+        scheduler.submit("b", item)
+
+    assert drain(scheduler) == ["a1", "a2", "b1", "a3", "a4", "b2", "b3"]
+    assert scheduler.queued() == 0
+
+def test_idle_organization_does_not_keep_credit():
+    scheduler = FairOffenseScheduler(weights={"a": 3}, default_concurrency=10)
+    scheduler.submit("a", "a1")
+    assert drain(scheduler) == ["a1"]
+
+    scheduler.submit("b", "b1")
+    scheduler.submit("a", "a2")
+    scheduler.submit("b", "b2")
+    assert drain(scheduler) == ["b1", "a2", "b2"]
+
+def test_organization_at_its_concurrency_limit_is_skipped():
+    scheduler = FairOffenseScheduler(weights={"a": 2})
+    scheduler.submit("a", "a1")
+    scheduler.submit("a", "a2")
+    scheduler.submit("b", "b1")
+    scheduler.submit("b", "b2")
+
+    assert scheduler.next(timeout=0) == ("a", "a1")
+    #a can only post one offense at a time: b is served while a1 is posted
+    assert scheduler.next(timeout=0) == ("b", "b1")
+    assert scheduler.next(timeout=0) is None
+    assert scheduler.queued_by_org() == {"a": 1, "b": 1}
+
+    #a kept the credit of its turn, so it goes before b2
+    scheduler.task_done("b")
+    scheduler.task_done("a")
+    assert scheduler.next(timeout=0) == ("a", "a2")
+    assert scheduler.next(timeout=0) == ("b", "b2")
+
+def test_waiting_worker_is_woken_when_a_post_finishes():
+    scheduler = FairOffenseScheduler()
+    scheduler.submit("a", "a1")
+    scheduler.submit("a", "a2")
+    assert scheduler.next(timeout=0) == ("a", "a1")
+
+    picked = []
+    worker = threading.Thread(target=lambda: picked.append(scheduler.next(timeout=5)))
+    worker.start()
+    time.sleep(0.05)
+    assert picked == []
+    scheduler.task_done("a")
+    worker.join(5)
+    assert picked == [("a", "a2")]
+
+def test_concurrent_workers_respect_the_concurrency_limits():
+    limits = {"a": 2, "b": 1, "c": 3}
+    scheduler = FairOffenseScheduler(concurrency_limits=limits)
+    for org in limits:
+        for i in range(20):
+            scheduler.submit(org, f"{org}{i}")
+
+    lock = threading.Lock()
+    in_flight = {org: 0 for org in limits}
+    max_in_flight = {org: 0 for org in limits}
+    posted = []
+
+    def worker():
+        while True:
+            next_item = scheduler.next(timeout=0.2)
+            if next_item is None:
+                return
+            org, item = next_item
+            with lock:
+                in_flight[org] += 1
+                max_in_flight[org] = max(max_in_flight[org], in_flight[org])
+            time.sleep(0.001)
+            with lock:
+                in_flight[org] -= 1
+                posted.append(item)
+            scheduler.task_done(org)
+
+    workers = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join(10)
+
+    assert sorted(posted) == sorted(f"{org}{i}" for org in limits for i in range(20))
+    assert all(max_in_flight[org] <= limits[org] for org in limits)
+    assert scheduler.queued() == 0
@@ -0,0 +1,61 @@
+import time
+import pytest
+from lease_coordination import LeaseCoordinator, SQLiteLeaseStore
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteLeaseStore(str(tmp_path / "leases.db"))
+
+def test_acquire_respects_the_limit_and_the_leases_of_other_instances(store):
+    assert sorted(store.acquire(["1", "2", "3"], "a", 30, 2)) == ["1", "2"]
+    assert sorted(store.acquire(["1", "2", "3"], "b", 30, 2)) == ["3"]
+    #Owned partitions are renewed before claiming new ones
+    assert sorted(store.acquire(["3", "1", "2"], "a", 30, 2)) == ["1", "2"]
+
+def test_expired_leases_are_taken_over(store):
+    store.acquire(["1"], "a", 0.05, 1)
+    assert store.acquire(["1"], "b", 30, 1) == {}
+    time.sleep(0.1)
+    assert list(store.acquire(["1"], "b", 30, 1)) == ["1"]
+
+def test_checkpoint_is_fenced_by_the_lease(store):
+    store.acquire(["1"], "a", 0.05, 1)
+    assert store.save_checkpoint("1", 110, "a")
+    assert not store.save_checkpoint("1", 120, "b")
+
+    #a stalls past its lease and b takes the partition over: the late save of a is rejected
+    time.sleep(0.1)
+    store.acquire(["1"], "b", 30, 1)
+    assert not store.save_checkpoint("1", 130, "a")
+    assert store.get_checkpoints(["1", "2"]) == {"1": 110}
+
+    #Released leases do not allow saving either
+    store.release(["1"], "b")
+    assert not store.save_checkpoint("1", 130, "b")
+
+def test_checkpoint_never_moves_back(store):
+    store.acquire(["1"], "a", 30, 1)
+    assert store.save_checkpoint("1", 120, "a")
+    assert store.save_checkpoint("1", 110, "a")
+    assert store.get_checkpoints(["1"]) == {"1": 120}
+
+def test_renewed_leases_are_owned_until_the_next_heartbeat(store):
+    coordinator = LeaseCoordinator(store, "a", ["1", "2"], lease_ttl=3, heartbeat_interval=1)
+    coordinator.refresh_leases()
+    assert coordinator.owned_partitions() == {"1", "2"}
+    #Past the renewal margin the lease may expire before the next heartbeat, so the partition is not worked on
+    coordinator._leases["1"] = time.time() + 0.5
+    assert coordinator.owned_partitions() == {"2"}
+
+def test_posts_are_forgotten_once_checkpointed(store):
+    store.acquire(["1", "2"], "a", 30, 2)
+    for offense_id in (101, 102, 103):
+        store.record_post("1", offense_id, "a")
+    store.record_post("2", 201, "a")
+
+    assert store.get_posts(["1"]) == {101, 102, 103}
+    assert not store.save_checkpoint("1", 102, "b")
+    assert store.get_posts(["1"]) == {101, 102, 103}
+    assert store.save_checkpoint("1", 102, "a")
+    assert store.get_posts(["1", "2"]) == {103, 201}
+    assert store.get_posts([]) == set()
@@ -0,0 +1,42 @@
+import random
+import re
+import pytest
+from qradar_siem_offenses_to_soar import build_offense_filter, build_offense_filter_chunks
+
+CLAUSE = re.compile(r"id > (-?\d+) and domain_id in \(([^)]*)\)")
+
+def parse_filter(offense_filter):
+    '''Returns the checkpoint of every domain of a filter.'''
+    return {domain: int(checkpoint) for checkpoint, domains in CLAUSE.findall(offense_filter) for domain in domains.split(",")}
+
+def test_domains_sharing_a_checkpoint_are_grouped_in_one_clause():
+    assert build_offense_filter({"1": 100, "2": 100}) == "status=OPEN and id > 100 and domain_id in (1,2)"
+    assert build_offense_filter({"1": 100, "2": 105}) == "status=OPEN and ((id > 100 and domain_id in (1)) or (id > 105 and domain_id in (2)))"
+    assert build_offense_filter_chunks({}, 10, 1000) == []
+
+@pytest.mark.parametrize("seed", range(20))
+def test_chunks_respect_the_bounds_and_cover_every_domain(seed):
+    rng = random.Random(seed)
+    domain_checkpoints = {str(domain): rng.choice([100, 2500, 123456, rng.randint(0, 10 ** 7)]) for domain in rng.sample(range(1, 100000), rng.randint(1, 300))}
+    chunk_size = rng.randint(1, 60)
+    max_length = rng.randint(100, 3000)
+
+    chunks = build_offense_filter_chunks(domain_checkpoints, chunk_size, max_length)
+
+    covered = {}
+    for offense_filter in chunks:
+        chunk = parse_filter(offense_filter)
+        assert offense_filter == build_offense_filter(chunk)
+        assert 1 <= len(chunk) <= chunk_size
+        assert len(offense_filter) <= max_length
+        assert not set(chunk) & set(covered)
+        covered.update(chunk)
+    assert covered == domain_checkpoints
+
+def test_domain_that_does_not_fit_starts_a_new_filter():
+    chunks = build_offense_filter_chunks({"1": 100, "123456789": 987654321, "2": 100}, 10, 60)
+    assert [parse_filter(offense_filter) for offense_filter in chunks] == [{"1": 100, "2": 100}, {"123456789": 987654321}]
+
+def test_domain_longer_than_the_max_length_gets_its_own_filter():
+    chunks = build_offense_filter_chunks({"1": 100, "2": 100}, 10, 20)
+    assert [parse_filter(offense_filter) for offense_filter in chunks] == [{"1": 100}, {"2": 100}]
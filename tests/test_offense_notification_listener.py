@@ -0,0 +1,40 @@
+import http.client
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+import offense_notification_listener
+from offense_notification_listener import ALL_DOMAINS, OffenseNotificationQueue
+
+@pytest.fixture
+def webhook(monkeypatch):
+    queue = OffenseNotificationQueue(coalesce_window=0)
+    monkeypatch.setattr(offense_notification_listener, "notification_queue", queue)
+    monkeypatch.setattr(offense_notification_listener, "notification_token", "secret")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), offense_notification_listener._WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def post(path="/", body=b"", headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        connection.putrequest("POST", path)
+        for name, value in {"X-Notification-Token": "secret", "Content-Length": str(len(body)), **(headers or {})}.items():
+            connection.putheader(name, value)
+        connection.endheaders(body)
+        status = connection.getresponse().status
+        connection.close()
+        return status, queue.wait(0)
+
+    yield post
+    server.shutdown()
+    server.server_close()
+
+def test_domain_is_taken_from_the_body_or_the_query_string(webhook):
+    assert webhook(body=b'{"domain_id": 3, "offense_id": 1234}') == (202, {"3"})
+    assert webhook(path="/?domain_id=4") == (202, {"4"})
+    assert webhook(body=b'not json') == (202, {ALL_DOMAINS})
+
+def test_malformed_content_length_still_gets_a_response(webhook):
+    assert webhook(body=b'{"domain_id": 3}', headers={"Content-Length": "abc"}) == (202, {ALL_DOMAINS})
+
+def test_notifications_without_the_token_are_rejected(webhook):
+    assert webhook(body=b'{"domain_id": 3}', headers={"X-Notification-Token": "wrong"}) == (401, set())
+    assert webhook(body=b'{"domain_id": 3}', headers={"X-Notification-Token": "sécret"}) == (401, set())
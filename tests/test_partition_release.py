@@ -0,0 +1,81 @@
+import threading
+import time
+import pytest
+import lease_coordination
+import qradar_siem_offenses_to_soar as offenses_to_soar
+from escalation_outbox import EscalationOutbox
+from lease_coordination import LeaseCoordinator, SQLiteLeaseStore
+from qradar_siem_offenses_to_soar import CheckpointTracker, InFlightPosts
+
+@pytest.fixture
+def instance(tmp_path, monkeypatch):
+    '''Instance "a" holding the leases of domains 1 and 2, with a SOAR post that blocks until it is released.'''
+    store = SQLiteLeaseStore(str(tmp_path / "leases.db"))
+    coordinator = LeaseCoordinator(store, "a", ["1", "2"], lease_ttl=30, heartbeat_interval=1)
+    monkeypatch.setattr(lease_coordination, "coordinator", coordinator)
+    monkeypatch.setattr(offenses_to_soar, "checkpoint_tracker", CheckpointTracker())
+    monkeypatch.setattr(offenses_to_soar, "in_flight_posts", InFlightPosts())
+    monkeypatch.setattr(offenses_to_soar, "escalation_outbox", EscalationOutbox(str(tmp_path / "outbox.jsonl")))
+    coordinator.add_release_listener(offenses_to_soar.release_domains)
+    coordinator.refresh_leases()
+
+    instance = type("Instance", (), {})()
+    instance.store = store
+    instance.coordinator = coordinator
+    instance.posted = []
+    instance.post_started = threading.Event()
+    instance.post_released = threading.Event()
+
+    def create_offense_in_soar(offense):
+        instance.posted.append(offense["id"])
+        instance.post_started.set()
+        assert instance.post_released.wait(5)
+    monkeypatch.setattr(offenses_to_soar, "create_offense_in_soar", create_offense_in_soar)
+
+    #Checkpoint of the partitions when their leases are released
+    instance.checkpoints_on_release = []
+    release = store.release
+    def record_release(partitions, owner):
+        instance.checkpoints_on_release.append(store.get_checkpoints(partitions))
+        release(partitions, owner)
+    monkeypatch.setattr(store, "release", record_release)
+    return instance
+
+def fetch(domain_id, offense_ids):
+    key = offenses_to_soar.checkpoint_key(domain_id)
+    tracker = offenses_to_soar.checkpoint_tracker
+    tracker.fetch_checkpoint(key, domain_id, 100)
+    items = [({"id": offense_id, "domain_id": int(domain_id)}, key, tracker.track(key, offense_id)) for offense_id in offense_ids]
+    tracker.advance(key, domain_id, max(offense_ids))
+    offenses_to_soar.escalation_outbox.record_queued([(offense, key) for offense, key, _ in items])
+    return items
+
+def test_release_waits_for_the_post_in_flight_and_saves_its_checkpoint(instance):
+    (in_flight, queued) = fetch("2", [101, 102])
+    post = threading.Thread(target=offenses_to_soar.process_offense, args=in_flight)
+    post.start()
+    assert instance.post_started.wait(5)
+
+    #A second instance joins, so "a" releases one of its two domains while 101 is being posted
+    instance.store.heartbeat("b")
+    rebalance = threading.Thread(target=instance.coordinator.refresh_leases)
+    rebalance.start()
+    time.sleep(0.2)
+    assert rebalance.is_alive()
+    assert instance.checkpoints_on_release == []
+
+    instance.post_released.set()
+    post.join(5)
+    rebalance.join(5)
+
+    #The checkpoint of the post was saved while the lease was still held, so the new owner never posts 101 again
+    assert instance.checkpoints_on_release == [{"2": 101}]
+    assert instance.coordinator.owned_partitions() == {"1"}
+    assert "2" not in offenses_to_soar.checkpoint_tracker.keys()
+    #The outbox does not keep the entries of the released domain (102 is still queued): the new owner fetches them again
+    assert EscalationOutbox(offenses_to_soar.escalation_outbox.file_path).load() == {}
+
+    #Offenses queued before the release are left to the new owner
+    offenses_to_soar.process_offense(*queued)
+    assert instance.posted == [101]
+    assert instance.store.get_checkpoints(["2"]) == {"2": 101}
@@ -0,0 +1,50 @@
+import pytest
+import requests
+import app_config
+import qradar_siem_offenses_to_soar
+import reupload_failed_offenses_to_soar as reupload
+from dead_letter_store import get_dead_letter_offense_ids
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_config.server_config, "dead_letter_offenses_file", str(tmp_path / "dead_letter.jsonl"))
+    monkeypatch.setattr(app_config.server_config, "failed_escalations_offenses_file", str(tmp_path / "failed.txt"))
+    monkeypatch.setattr(app_config.server_config, "customer_configurations_by_domain", {"1": {"soar_org_id": "201", "soar_api_key_auth": "key"}})
+    monkeypatch.setattr(qradar_siem_offenses_to_soar, "config", app_config.server_config)
+    monkeypatch.setattr(reupload, "config", app_config.server_config)
+    monkeypatch.setattr(reupload, "get_offense", lambda offense_id: {"id": offense_id, "domain_id": 1, "status": "OPEN", "description": "offense"})
+    qradar_siem_offenses_to_soar.save_failed_offense_creation_on_soar(101)
+    return app_config.server_config
+
+def soar_answering(status_code, posted):
+    '''Fake requests.post of SOAR: incident queries answer status_code, incident creations are recorded.'''
+    def post(url, data, headers, verify):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"data": []}'
+        if "query_paged" in url:
+            response.status_code = status_code
+        else:
+            posted.append(url)
+        response.url = url
+        return response
+    return post
+
+def test_failed_lookup_keeps_the_offense_on_the_failed_offenses_file(files, monkeypatch):
+    posted = []
+    monkeypatch.setattr(qradar_siem_offenses_to_soar.requests, "post", soar_answering(403, posted))
+
+    reupload.process_offense(101)
+
+    assert posted == []
+    assert qradar_siem_offenses_to_soar.load_failed_offense_ids() == ["101"]
+    assert get_dead_letter_offense_ids(files.dead_letter_offenses_file) == set()
+
+def test_offense_not_found_on_soar_is_posted_again(files, monkeypatch):
+    posted = []
+    monkeypatch.setattr(qradar_siem_offenses_to_soar.requests, "post", soar_answering(200, posted))
+
+    reupload.process_offense(101)
+
+    assert len(posted) == 1
+    assert qradar_siem_offenses_to_soar.load_failed_offense_ids() == []